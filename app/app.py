@@ -1,5 +1,68 @@
-from appmodels import load_best_model, prep_data_from_user
-from flask import Flask, flash, render_template, request
+import hmac
+import io
+import json
+import os
+import signal
+import threading
+import time
+
+import numpy as np
+from appmodels import (
+    FEATURE_COLUMNS,
+    current_data_hash,
+    load_best_model,
+    model_artifact_name,
+    needs_imputation,
+    prep_data_from_records,
+)
+from artifacts import ArtifactManager
+from compact_forest import COMPACT_MODEL_DIR, compact_model_sha256, load_compact_forest
+from flask import Flask, Response, flash, jsonify, render_template, request
+from forecast import FORECAST_HOURS, forecast, forecast_rows, read_forecast
+from forest_engine import FlatForest, tree_predictions
+from micro_batcher import MicroBatcher
+from prediction_cache import PredictionCache, canonical_inputs
+from response_surface import RESPONSE_SURFACE_DIR, load_response_surface
+from serving import ModelHolder
+from sklearn.ensemble import RandomForestRegressor
+
+# load the memory mapped forest made by compact_forest.py, if it exists
+USE_COMPACT_MODEL = False
+# predict with the flattened forest instead of sklearn, which is much faster for single rows
+USE_FLAT_ENGINE = True
+# answer from the precomputed grid made by response_surface.py if it exists,
+# inputs it can not answer (missing or outside the grid) still go to the model
+USE_RESPONSE_SURFACE = False
+# percentiles across the trees shown as the likely range of the prediction
+INTERVAL_QUANTILES = [10, 90]
+# cache website predictions for repeated inputs, see prediction_cache.py
+USE_PREDICTION_CACHE = True
+# predict concurrent website requests together, see micro_batcher.py
+USE_MICRO_BATCHING = True
+# "client": send one cyclist and the count, the browser draws the rest, so the page is the same size
+# for any prediction. "capped": draw at most MAX_CYCLE_ART cyclists on the server. "full": draw them all
+CYCLE_ART_MODE = "client"
+MAX_CYCLE_ART = 50
+# restart app.run when a source file changes
+USE_RELOADER = True
+# reload the model when its artifact changes (checked at most every WATCH_INTERVAL seconds, on requests)
+WATCH_ARTIFACTS = True
+WATCH_INTERVAL = 5.0
+# POST /admin/reload with this token in the X-Admin-Token header reloads the model, off if not set
+ADMIN_TOKEN = os.environ.get("CYCLE_ADMIN_TOKEN")
+# a new model is only served if it predicts these without errors, and within SMOKE_RANGE
+SMOKE_INPUTS = [
+    {"DateFormatted": "2023-01-02 08:00:00", "Lufttemperatur": "-3", "Vindkast": "4"},
+    {"DateFormatted": "2023-03-15 16:00:00", "Lufttemperatur": "6", "Vindkast": "8"},
+    {"DateFormatted": "2023-06-01 08:00:00", "Globalstraling": "300"},
+    {"DateFormatted": "2023-07-15 03:00:00"},
+    {"DateFormatted": "2023-10-10 12:00:00", "Solskinstid": "5", "Lufttrykk": "1010"},
+]
+SMOKE_RANGE = (-100, 10000)
+# most rows /api/predict takes in one request
+MAX_API_ROWS = 10000
+# rows prepared and predicted at a time when /api/predict streams its answer
+STREAM_CHUNK_ROWS = 500
 
 print("Starting app...")
 print(
@@ -40,29 +103,417 @@ print(
 app = Flask(__name__)
 app.secret_key = "Haper_rettingen_er_goy_:)"
 
-predictor = load_best_model()
 
+def load_serving_models(build: bool = True) -> dict:
+    """
+    Loads (or builds, the first time) what the website predicts with
 
-@app.route("/", methods=["GET", "POST"])
-def home():
-    if request.method == "POST":
-        input_dict = request.form.to_dict()
-        print(f" INPUT : {input_dict}")
-        prepped_data = prep_data_from_user(input_dict)
-        print(f" INPUT: PREPPED DATA = {prepped_data}")
+    If build is False (hot reloads) only a valid saved model is used, it is never trained here.
+    Reloads always load the model artifact (the one artifact_stamp watches), not the compact forest,
+    which is made from an older model by compact_forest.py and would serve that model again.
+    At startup the compact forest is only used if it was made from the current model artifact.
+    The response surface is only used if it was built from the model artifact that is served
 
-        if isinstance(prepped_data, str):
-            flash(
-                f"ERROR: Ensure all inputs types are numbers, and the date is in the proper format"
+    Returns a dict with the predictor, the response surface (None if not used) and the model version
+    """
+    artifacts = ArtifactManager()
+    manifest_before = artifacts.manifest(model_artifact_name())
+
+    use_compact = build and USE_COMPACT_MODEL and os.path.isdir(COMPACT_MODEL_DIR)
+    if use_compact and (
+        manifest_before is None or compact_model_sha256() != manifest_before["sha256"]
+    ):
+        print(
+            "INFO : The compact model was made from another model, loading the model artifact instead"
+        )
+        use_compact = False
+
+    if use_compact:
+        predictor = load_compact_forest()
+    elif build:
+        predictor = load_best_model()
+    else:
+        predictor = artifacts.load(
+            model_artifact_name(), FEATURE_COLUMNS, current_data_hash()
+        )
+        if predictor is None:
+            raise FileNotFoundError(
+                f"No valid model at {artifacts.path(model_artifact_name())}"
             )
-            return render_template("home.html")
 
-        trafficamount = predictor.predict(prepped_data)
+    if USE_FLAT_ENGINE and isinstance(predictor, RandomForestRegressor):
+        predictor = FlatForest.from_forest(predictor)
 
-        # bruk floor her TODO
-        trafficamount = int(trafficamount[0])
+    # the sha256 of the model artifact, so cached predictions are dropped when the model changes
+    manifest = artifacts.manifest(model_artifact_name())
+    if use_compact:
+        # the compact forest matched the artifact as it was before loading
+        manifest = manifest_before
+    if not build and manifest != manifest_before:
+        raise RuntimeError("The model artifact changed while it was loaded")
+    version = manifest["sha256"] if manifest else f"loaded {time.time()}"
+
+    surface = None
+    if USE_RESPONSE_SURFACE and os.path.isdir(RESPONSE_SURFACE_DIR):
+        surface = load_response_surface()
+        if manifest is None or surface.model_sha256 != manifest["sha256"]:
+            print(
+                "INFO : The response surface was built from another model, build it again with response_surface.py"
+            )
+            surface = None
+
+    return {"predictor": predictor, "surface": surface, "version": version}
+
+
+def validate_serving_models(serving: dict) -> None:
+    """
+    Smoke test of a newly loaded model before it is served
+
+    Raises ValueError if it can not predict SMOKE_INPUTS, or predicts outside SMOKE_RANGE
+    """
+    predictions = predict_user_batch(serving, SMOKE_INPUTS)
+
+    for input_dict, prediction in zip(SMOKE_INPUTS, predictions):
+        if prediction is None:
+            raise ValueError(f"Could not predict {input_dict}")
+        value = float(prediction[0])
+        if not SMOKE_RANGE[0] <= value <= SMOKE_RANGE[1]:
+            raise ValueError(f"Predicted {value} for {input_dict}")
+
+
+def artifact_stamp() -> tuple:
+    """
+    Returns the mtime and size of the model's manifest, which is written after the model
+    (see ArtifactManager.save), so it only changes once a new model is complete
+    """
+    try:
+        stat = os.stat(ArtifactManager().manifest_path(model_artifact_name()))
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def reload_on_signal(signum, frame) -> None:
+    models.reload()
+
+
+# the model is loaded in the background, so the server starts right away
+models = ModelHolder(
+    load_serving_models,
+    reload=lambda: load_serving_models(build=False),
+    validate=validate_serving_models,
+)
+prediction_cache = PredictionCache()
+
+
+def start_serving() -> None:
+    """
+    Starts warming up the model, and watching for new ones, in the process that serves requests
+    """
+    models.start()
+    if WATCH_ARTIFACTS:
+        models.watch(artifact_stamp, WATCH_INTERVAL)
+    # kill -HUP <pid> reloads the model, signals can only be set up from the main thread
+    if hasattr(signal, "SIGHUP") and threading.current_thread() == threading.main_thread():
+        signal.signal(signal.SIGHUP, reload_on_signal)
+
+
+# imported by a server (serve.py, asgi.py, gunicorn ..), see the __main__ block for app.run
+if __name__ != "__main__":
+    start_serving()
+
+
+@app.before_request
+def check_for_new_model():
+    models.poll()
+
+
+@app.route("/admin/reload", methods=["POST"])
+def admin_reload():
+    """
+    Reloads the model in the background, needs the CYCLE_ADMIN_TOKEN in the X-Admin-Token header.
+    GET /readyz shows how the last reload went
+    """
+    token = request.headers.get("X-Admin-Token", "")
+    if ADMIN_TOKEN is None or not hmac.compare_digest(
+        token.encode(), ADMIN_TOKEN.encode()
+    ):
+        return jsonify({"error": "Not found"}), 404
+
+    return jsonify({"reloading": models.reload(), **models.status()}), 202
+
+
+@app.route("/healthz")
+def healthz():
+    """
+    Liveness, the server is up even if the model is still warming up
+    """
+    return jsonify({"status": "alive"})
+
+
+@app.route("/readyz")
+def readyz():
+    """
+    Readiness, 200 once the model is loaded, 503 until then
+    """
+    status = models.status()
+    return jsonify(status), 200 if status["status"] == "ready" else 503
+
+
+@app.route("/cachez")
+def cachez():
+    """
+    Hit rate and counters of the prediction cache
+    """
+    return jsonify(prediction_cache.stats())
+
+
+@app.route("/batchz")
+def batchz():
+    """
+    How many requests the micro batcher has predicted together
+    """
+    return jsonify(micro_batcher.stats())
+
+
+def predict_user_batch(serving: dict, input_dicts: list) -> list:
+    """
+    Predicts many website inputs at once, preparing the data is the slow part and
+    takes about as long for a batch as for one row.
+
+    Returns a list with (prediction, [P10, P90] or None) per input, or None for inputs that can not be read
+    """
+    predictor = serving["predictor"]
+
+    try:
+        prepped_data = prep_data_from_records(
+            input_dicts, impute=needs_imputation(predictor)
+        )
+    except (TypeError, ValueError) as e:
+        if len(input_dicts) == 1:
+            print(e)
+            return [None]
+        # one bad input should not fail the others
+        return [predict_user_batch(serving, [d])[0] for d in input_dicts]
+
+    print(f" INPUT: PREPPED DATA = {prepped_data}")
+
+    # forests predict every tree once, the mean is the prediction and the percentiles the range
+    trees = tree_predictions(predictor, prepped_data)
+    if trees is None:
+        return [(value, None) for value in predictor.predict(prepped_data)]
+
+    ranges = np.percentile(trees, INTERVAL_QUANTILES, axis=1).T
+    return [
+        (row.mean(), [int(value) for value in row_range])
+        for row, row_range in zip(trees, ranges)
+    ]
+
+
+# requests waiting at the same time are prepared and predicted together
+micro_batcher = MicroBatcher(predict_user_batch)
+
+
+def predict_from_user(serving: dict, input_dict: dict):
+    """
+    Predicts one hour from the inputs of the website
+
+    Returns (prediction, [P10, P90] or None), or None if the inputs can not be read
+    """
+    surface = serving["surface"]
+    if surface is not None:
+        trafficamount = surface.predict_from_user(input_dict)
+        if trafficamount is not None:
+            return trafficamount, None
 
-        cyclist = f"""     
+    if USE_MICRO_BATCHING:
+        return micro_batcher.predict(input_dict, group=serving)
+
+    return predict_user_batch(serving, [input_dict])[0]
+
+
+def predict_rows(predictor, records: list) -> list:
+    """
+    Prepares and predicts many hours with one call to the model
+
+    Returns a list with a dict per record, with the date, the prediction and for forests the range
+    """
+    X = prep_data_from_records(records, impute=needs_imputation(predictor))
+
+    trees = tree_predictions(predictor, X)
+    if trees is not None:
+        predictions = trees.mean(axis=1)
+        low, high = np.percentile(trees, INTERVAL_QUANTILES, axis=1)
+    else:
+        predictions = predictor.predict(X)
+        low = high = None
+
+    rows = []
+    for i, date in enumerate(X.index):
+        row = {"DateFormatted": str(date), "prediction": int(predictions[i])}
+        if low is not None:
+            row[f"p{INTERVAL_QUANTILES[0]}"] = int(low[i])
+            row[f"p{INTERVAL_QUANTILES[1]}"] = int(high[i])
+        rows.append(row)
+
+    return rows
+
+
+def api_records(body) -> list:
+    """
+    Returns the rows of an /api/predict body, a list of rows or {"rows": [...]}
+
+    Raises ValueError if the body is not one of those, or has too many or no rows
+    """
+    records = body.get("rows") if isinstance(body, dict) else body
+
+    if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+        raise ValueError('Send a JSON list of rows, or {"rows": [...]}')
+    if not 0 < len(records) <= MAX_API_ROWS:
+        raise ValueError(f"Send between 1 and {MAX_API_ROWS} rows")
+
+    return records
+
+
+def stream_rows(predictor, records: list):
+    """
+    Yields one JSON line per record, STREAM_CHUNK_ROWS records are prepared and predicted at a time
+    """
+    for start in range(0, len(records), STREAM_CHUNK_ROWS):
+        try:
+            rows = predict_rows(predictor, records[start : start + STREAM_CHUNK_ROWS])
+        except (TypeError, ValueError) as e:
+            yield json.dumps({"error": str(e), "row": start}) + "\n"
+            return
+        for row in rows:
+            yield json.dumps(row) + "\n"
+
+
+@app.route("/api/predict", methods=["POST"])
+def api_predict():
+    """
+    Predicts many hours in one request.
+
+    Takes a JSON list of rows (or {"rows": [...]}), each with DateFormatted and the weather inputs
+    of the website. Returns {"predictions": [...]} in the same order, or with ?stream=1 one JSON line
+    per row (application/x-ndjson, also when asked for in Accept), prepared and predicted
+    STREAM_CHUNK_ROWS rows at a time.
+    """
+
+    serving = models.get()
+    if serving is None:
+        return jsonify(models.status()), 503
+    predictor = serving["predictor"]
+
+    try:
+        records = api_records(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if (
+        request.args.get("stream")
+        or request.accept_mimetypes.best == "application/x-ndjson"
+    ):
+        return Response(
+            stream_rows(predictor, records), mimetype="application/x-ndjson"
+        )
+
+    try:
+        rows = predict_rows(predictor, records)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({"predictions": rows})
+
+
+def forecast_request(predictor, csv, start: str = None, hours: str = None) -> list:
+    """
+    Input:
+        predictor: what the app predicts with
+        csv: file object of a weather forecast in the florida layout
+        start/hours: from the query string, see forecast.forecast
+
+    Returns the forecast rows, raises ValueError if the forecast or the arguments can not be used
+    """
+    try:
+        hours = FORECAST_HOURS if hours is None else int(hours)
+        raw = read_forecast(csv)
+        predictions = forecast(raw, predictor, start, hours)
+    except (TypeError, KeyError) as e:
+        raise ValueError(f"Could not read the forecast: {e}")
+
+    return forecast_rows(predictions)
+
+
+@app.route("/api/forecast", methods=["POST"])
+def api_forecast():
+    """
+    Predicts every hour of an uploaded weather forecast (a florida layout csv, as the "file" field
+    of a form, or as the body with Content-Type text/csv), ?hours=48 and ?start=2023-06-01 00:00 set the horizon.
+
+    Returns {"forecast": [...]} with a row per hour like /api/predict
+    """
+
+    serving = models.get()
+    if serving is None:
+        return jsonify(models.status()), 503
+
+    csv = request.files.get("file")
+    if csv is None:
+        if not request.data:
+            return (
+                jsonify({"error": "Upload the forecast as file, or send it as text/csv"}),
+                400,
+            )
+        csv = io.BytesIO(request.data)
+
+    try:
+        rows = forecast_request(
+            serving["predictor"],
+            csv,
+            request.args.get("start"),
+            request.args.get("hours"),
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({"forecast": rows})
+
+
+def cached_prediction(serving: dict, input_dict: dict):
+    """
+    predict_from_user, answered from the prediction cache when the same inputs were seen before.
+    The (rounded) key is only used for the lookup, a new prediction is made from the inputs as sent
+
+    Returns (prediction, [P10, P90] or None), or None if the inputs can not be read
+    """
+    key = canonical_inputs(input_dict) if USE_PREDICTION_CACHE else None
+    if key is None:
+        return predict_from_user(serving, input_dict)
+
+    prediction = prediction_cache.get(key, serving["version"])
+    if prediction is None:
+        prediction = predict_from_user(serving, input_dict)
+        if prediction is not None:
+            prediction_cache.put(key, serving["version"], prediction)
+
+    return prediction
+
+
+def draw_cycle_art(trafficamount: int, mode: str = None) -> dict:
+    """
+    Input:
+        trafficamount: predicted cyclists
+        mode: see CYCLE_ART_MODE, CYCLE_ART_MODE if None
+
+    Returns the template arguments for the cyclists, cycle_art and how many times the browser repeats it
+    """
+    if mode is None:
+        mode = CYCLE_ART_MODE
+    if trafficamount <= 0:
+        return {"cycle_art": "", "cycle_art_repeat": 1}
+
+    cyclist = f"""     
                             _______________   
                           / Hei Nello :^)     
                          <  I am one of {trafficamount}!   >
@@ -72,11 +523,53 @@ def home():
 
                 """
 
-        cyclist_row = " " * 20  # Specifies the distance between each cyclist
-        cycle_art = (cyclist + cyclist_row) * trafficamount
+    cyclist_row = " " * 20  # Specifies the distance between each cyclist
+
+    if mode == "client":
+        return {"cycle_art": cyclist + cyclist_row, "cycle_art_repeat": trafficamount}
+
+    if mode == "capped" and trafficamount > MAX_CYCLE_ART:
+        return {
+            "cycle_art": (cyclist + cyclist_row) * MAX_CYCLE_ART
+            + f"\n... and {trafficamount - MAX_CYCLE_ART} more",
+            "cycle_art_repeat": 1,
+        }
+
+    return {"cycle_art": (cyclist + cyclist_row) * trafficamount, "cycle_art_repeat": 1}
+
+
+@app.route("/", methods=["GET", "POST"])
+def home():
+    if request.method == "POST":
+        serving = models.get()
+        if serving is None:
+            flash(
+                "The model is warming up, please try again in a moment"
+                if models.error is None
+                else "ERROR: The model could not be loaded"
+            )
+            return render_template("home.html"), 503
+
+        input_dict = request.form.to_dict()
+        print(f" INPUT : {input_dict}")
+
+        prediction = cached_prediction(serving, input_dict)
+        if prediction is None:
+            flash(
+                f"ERROR: Ensure all inputs types are numbers, and the date is in the proper format"
+            )
+            return render_template("home.html")
+
+        trafficamount, traffic_range = prediction
+
+        # bruk floor her TODO
+        trafficamount = int(trafficamount)
 
         return render_template(
-            "home.html", traffic_data=trafficamount, cycle_art=cycle_art
+            "home.html",
+            traffic_data=trafficamount,
+            traffic_range=traffic_range,
+            **draw_cycle_art(trafficamount),
         )
 
     else:
@@ -84,4 +577,8 @@ def home():
 
 
 if __name__ == "__main__":
-    app.run(debug=True, port="8080")
+    # with the reloader this process only watches for changes, and runs this file again in a child
+    # process (with WERKZEUG_RUN_MAIN set) that serves requests, only that one should load the model
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true" or not USE_RELOADER:
+        start_serving()
+    app.run(debug=True, port="8080", use_reloader=USE_RELOADER)
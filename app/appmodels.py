@@ -1,12 +1,13 @@
 import os
-import pickle
 from datetime import datetime
+from functools import lru_cache
 from io import StringIO
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-from sklearn.ensemble import RandomForestRegressor
+from artifacts import ArtifactManager, raw_data_hash
+from sklearn.ensemble import HistGradientBoostingRegressor, RandomForestRegressor
 from sklearn.impute import KNNImputer
 from sklearn.model_selection import train_test_split
 
@@ -15,6 +16,59 @@ PWD = Path().absolute()
 RANDOM_STATE = 2
 DEBUG = True
 
+# "forest" for the RandomForestRegressor, "hist_gbm" for HistGradientBoostingRegressor
+BEST_MODEL_KIND = "forest"
+
+RAW_DATA_DIR = f"{PWD}/src/raw_data"
+
+# the fitted KNN imputer, see trim_transform_outliers
+IMPUTER_NAME = "knn_imputer"
+
+# the coloumns the model is trained on, in order
+FEATURE_COLUMNS = [
+    "Globalstraling",
+    "Solskinstid",
+    "Lufttemperatur",
+    "Lufttrykk",
+    "Vindkast",
+    "hour",
+    "d_Friday",
+    "d_Monday",
+    "d_Saturday",
+    "d_Sunday",
+    "d_Thursday",
+    "d_Tuesday",
+    "d_Wednesday",
+    "month",
+    "weekend",
+    "public_holiday",
+    "raining",
+    "summer",
+    "winter",
+    "rush_hour",
+    "sleeptime",
+    "Vindretning_x",
+    "Vindretning_y",
+]
+
+# days (month-day) counted as public holidays
+PUBLIC_HOLIDAYS = [
+    # jul osv
+    "12-24",
+    "12-25",
+    "01-01",
+    # påske
+    "04-06",
+    "04-07",
+    "04-08",
+    "04-09",
+    "04-10",
+    # labour day/17 mai
+    "05-01",
+    "05-17",
+    "05-18",
+]
+
 
 def treat_florida_files(filename: str) -> pd.DataFrame:
     """
@@ -209,26 +263,8 @@ def feauture_engineer(df: pd.DataFrame, data2023: bool) -> pd.DataFrame:
     # add weekend
     df["weekend"] = (df.index.weekday >= 5).astype(int)
 
-    # add public holidays
-    holidays = [
-        # jul osv
-        "12-24",
-        "12-25",
-        "01-01",
-        # påske
-        "04-06",
-        "04-07",
-        "04-08",
-        "04-09",
-        "04-10",
-        # labour day/17 mai
-        "05-01",
-        "05-17",
-        "05-18",
-    ]
-
     # add public holiday
-    df["public_holiday"] = df.index.strftime("%m-%d").isin(holidays).astype(int)
+    df["public_holiday"] = df.index.strftime("%m-%d").isin(PUBLIC_HOLIDAYS).astype(int)
 
     # add coloumn for rain if air pressure is higher than 1050 see README
     df["raining"] = df["Lufttrykk"] <= 996
@@ -318,11 +354,16 @@ def merge_frames(frames: list) -> pd.DataFrame:
     return df_2023, df_final
 
 
-def trim_transform_outliers(df: pd.DataFrame, data2023: bool) -> pd.DataFrame:
+def trim_transform_outliers(
+    df: pd.DataFrame, data2023: bool, impute: bool = True
+) -> pd.DataFrame:
     """
     Given a dataframe, trims values in the dataframe that are considered abnormal.
 
     What values are considered abnormal are covered in the README under "Dropped values"
+
+    If impute is False the abnormal values are left as NaN, for models that handle NaN
+    themselves (HistGradientBoostingRegressor)
     """
     # Transform malformed data to NaN.
     length_dict = {"before": len(df)}
@@ -393,25 +434,34 @@ def trim_transform_outliers(df: pd.DataFrame, data2023: bool) -> pd.DataFrame:
         columns=["Relativ luftfuktighet"], errors="ignore"
     )
 
-    pkl_filename = "pickle_knn.pkl"
+    if not impute:
+        if not data2023:
+            return pd.concat([df_no_traffic, total_traffic_series], axis=1)
+        return df_no_traffic
 
-    try:
-        with open(pkl_filename, "rb") as file:
-            imputer = pickle.load(file)
+    artifacts = ArtifactManager()
+    imputer = artifacts.load(
+        IMPUTER_NAME, list(df_no_traffic.columns), current_data_hash()
+    )
 
-            df_imputed = imputer.transform(df_no_traffic)
-            print("PICKLE : FOUND PICKLE")
+    if imputer is not None:
+        df_imputed = imputer.transform(df_no_traffic)
+        print("PICKLE : FOUND PICKLE")
 
-    except FileNotFoundError as e:
+    else:
         print("DID NOT FIND PICKLE -> MAKING IT!")
         imputer = KNNImputer(n_neighbors=20, weights="distance")
         df_imputed = imputer.fit_transform(df_no_traffic)
 
-        # pickle
+        # only an imputer fitted on the training data is worth keeping
         if len(df_no_traffic) > 40000:
-            with open(pkl_filename, "wb") as file:
-                print("PICKLE : PICKLING MADE MODEL")
-                pickle.dump(imputer, file)
+            print("PICKLE : PICKLING MADE MODEL")
+            artifacts.save(
+                IMPUTER_NAME,
+                imputer,
+                list(df_no_traffic.columns),
+                current_data_hash(),
+            )
 
     # print("DF NO TRAFFIC -> ")
     # print(df_no_traffic)
@@ -549,23 +599,26 @@ def treat_2023_file(df, model):
     return df_final
 
 
-def load_best_model() -> RandomForestRegressor:
+def needs_imputation(model) -> bool:
     """
-    Loads the best model
+    Returns True if the model needs NaN values imputed before predicting.
+    HistGradientBoostingRegressor handles NaN itself.
     """
+    return not isinstance(model, HistGradientBoostingRegressor)
 
-    # if the model already exists as pickle, return it
-    try:
-        pickled_model = pickle.load(open("app/model.pkl", "rb"))
-        return pickled_model
-    except FileNotFoundError as e:
-        pass
 
-    print("INFO : No pre-existing model found... building from baseline")
+def build_training_data(impute: bool = True) -> (pd.DataFrame, pd.Series):
+    """
+    Parses the raw data and runs it through the same processing as project.py
+
+    If impute is False, missing values are left as NaN (see needs_imputation)
+
+    Returns X_train, y_train
+    """
 
     print("INFO : Starting parsing on loading best model ... ")
     # loop over files in local directory
-    directory = f"{str(PWD)}/src/raw_data"  # change
+    directory = RAW_DATA_DIR
 
     # multiple florida files will all be converted to df's, placed in this list, and concacted
     florida_df_list = []
@@ -610,7 +663,9 @@ def load_best_model() -> RandomForestRegressor:
         print("PARSING : This could take a while...")
 
         # transform NaN and outliers to usable data
-        df_transforming = trim_transform_outliers(df_transforming, False)
+        df_transforming = trim_transform_outliers(
+            df_transforming, False, impute=impute
+        )
         print(f"PARSING : Outliers trimmed for {name}")
 
         # add important features to help the model
@@ -634,64 +689,119 @@ def load_best_model() -> RandomForestRegressor:
         "x_train": training_df.drop(["Total_trafikk"], axis=1),
     }
 
-    X_train = split_dict_post["x_train"]
-    y_train = split_dict_post["y_train"]
+    return split_dict_post["x_train"], split_dict_post["y_train"]
+
+
+def load_validation_data() -> (pd.DataFrame, pd.Series):
+    """
+    Loads the processed validation data saved by project.py
+
+    Returns X_val, y_val with the coloumns in FEATURE_COLUMNS order
+    """
+    df = pd.read_csv(
+        f"{str(PWD)}/src/raw_data/main_validation_data.csv",
+        index_col="DateFormatted",
+        parse_dates=True,
+    )
+    return df[FEATURE_COLUMNS], df["Total_trafikk"]
+
+
+@lru_cache(maxsize=None)
+def current_data_hash() -> str:
+    """
+    Hash of the raw data, worked out once per process, see artifacts.raw_data_hash
+    """
+    return raw_data_hash(RAW_DATA_DIR)
+
+
+def model_artifact_name() -> str:
+    """
+    Returns the artifact name of the best model, see BEST_MODEL_KIND
+    """
+    if BEST_MODEL_KIND == "forest":
+        return "model"
+    return f"model_{BEST_MODEL_KIND}"
+
+
+def load_best_model() -> RandomForestRegressor:
+    """
+    Loads the best model, see BEST_MODEL_KIND
+
+    The saved model is used if its manifest matches the feature coloumns, the raw data and
+    the installed libraries (see artifacts.ArtifactManager), otherwise it is trained again and saved
+    """
+
+    artifacts = ArtifactManager()
+
+    # if a valid model is already saved, return it
+    saved_model = artifacts.load(
+        model_artifact_name(), FEATURE_COLUMNS, current_data_hash()
+    )
+    if saved_model is not None:
+        return saved_model
+
+    print("INFO : No pre-existing model found... building from baseline")
+
+    # histogram boosting handles NaN, so the imputer is skipped for it
+    X_train, y_train = build_training_data(impute=BEST_MODEL_KIND == "forest")
 
     # BEST MODEL:
-    print("MODEL : Training best model")
-    best_model = RandomForestRegressor(n_estimators=181, random_state=2)
+    print(f"MODEL : Training best model ({BEST_MODEL_KIND})")
+    if BEST_MODEL_KIND == "hist_gbm":
+        best_model = HistGradientBoostingRegressor(
+            max_iter=500, learning_rate=0.1, max_leaf_nodes=63, random_state=2
+        )
+    else:
+        best_model = RandomForestRegressor(n_estimators=181, random_state=2)
     best_model.fit(X_train, y_train)
 
     # save model as pickle
-    pickle.dump(best_model, open("model.pkl", "wb"))
+    artifacts.save(
+        model_artifact_name(), best_model, FEATURE_COLUMNS, current_data_hash()
+    )
 
     return best_model
 
 
-def prep_data_from_user(input_dict):
-    """
-    Loads the best model
-    """
-    print("INFO : Starting prep data from user ... ")
+# the inputs the website and the API take for every hour
+INPUT_COLUMNS = [
+    "Globalstraling",
+    "Solskinstid",
+    "Lufttemperatur",
+    "Vindretning",
+    "Vindstyrke",
+    "Lufttrykk",
+    "Vindkast",
+]
 
-    col_keys = [
-        "DateFormatted",
-        "Globalstraling",
-        "Solskinstid",
-        "Lufttemperatur",
-        "Vindretning",
-        "Vindstyrke",
-        "Lufttrykk",
-        "Vindkast",
-    ]
 
-    df_dict = {}
+def prep_data_from_records(records: list, impute: bool = True) -> pd.DataFrame:
+    """
+    Input:
+        records: list of dicts with DateFormatted ("%Y-%m-%d %H:%M:%S") and the INPUT_COLUMNS,
+                 weather values can be numbers or strings, missing or "" values are NaN
+        impute: if False, missing values are left as NaN (see needs_imputation)
 
-    date_format = "%Y-%m-%d %H:%M:%S"
+    Turns many hours of inputs into a dataframe the model can predict on, all rows are
+    processed together (one imputer call, one feature pass).
 
-    for col in col_keys:
-        try:
-            if col in input_dict.keys():
-                if input_dict[col] == "":
-                    df_dict[col] = [np.nan]
-                    continue
+    Raises ValueError if a date or a number can not be read
 
-                if col == "DateFormatted":
-                    df_dict[col] = [datetime.strptime(input_dict[col], date_format)]
-                else:
-                    df_dict[col] = [float(input_dict[col])]
-            else:
-                df_dict[col] = [np.nan]
+    Returns a dataframe with the coloumns in FEATURE_COLUMNS order, in the same order as records
+    """
+    print(f"INFO : Starting prep data for {len(records)} rows ... ")
 
-        except (TypeError, ValueError) as e:
-            print(e)
-            return "ERROR"
+    df = pd.DataFrame.from_records(
+        records, columns=["DateFormatted"] + INPUT_COLUMNS
+    ).replace("", np.nan)
 
-    # print(df_dict)
+    df["DateFormatted"] = pd.to_datetime(df["DateFormatted"], format="%Y-%m-%d %H:%M:%S")
+    if df["DateFormatted"].isna().any():
+        raise ValueError("Every row needs a DateFormatted")
 
-    df = pd.DataFrame(df_dict)  # Converts input data into dataframe
+    for col in INPUT_COLUMNS:
+        df[col] = pd.to_numeric(df[col]).astype(float)
 
-    df["DateFormatted"] = pd.to_datetime(df["DateFormatted"])
     df.set_index("DateFormatted", inplace=True)
 
     name = "userinp"
@@ -702,7 +812,7 @@ def prep_data_from_user(input_dict):
     print("PARSING : This could take a while...")
 
     # transform NaN and outliers to usable data
-    df = trim_transform_outliers(df, True)
+    df = trim_transform_outliers(df, True, impute)
     print(f"PARSING : Outliers trimmed for {name}")
 
     # add important features to help the model
@@ -715,36 +825,27 @@ def prep_data_from_user(input_dict):
 
     print("PARSING : re-aranging df to fit")
 
-    df = df[
-        [
-            "Globalstraling",
-            "Solskinstid",
-            "Lufttemperatur",
-            "Lufttrykk",
-            "Vindkast",
-            "hour",
-            "d_Friday",
-            "d_Monday",
-            "d_Saturday",
-            "d_Sunday",
-            "d_Thursday",
-            "d_Tuesday",
-            "d_Wednesday",
-            "month",
-            "weekend",
-            "public_holiday",
-            "raining",
-            "summer",
-            "winter",
-            "rush_hour",
-            "sleeptime",
-            "Vindretning_x",
-            "Vindretning_y",
-        ]
-    ]
+    df = df[FEATURE_COLUMNS]
     return df
 
 
+def prep_data_from_user(input_dict, impute: bool = True):
+    """
+    Turns the inputs from the website into a dataframe the model can predict on
+
+    If impute is False, missing values are left as NaN (see needs_imputation)
+
+    Returns "ERROR" if the inputs can not be read
+    """
+    print("INFO : Starting prep data from user ... ")
+
+    try:
+        return prep_data_from_records([input_dict], impute)
+    except (TypeError, ValueError) as e:
+        print(e)
+        return "ERROR"
+
+
 if __name__ == "__main__":
     """
     Example run of prep data
@@ -763,7 +864,7 @@ if __name__ == "__main__":
         "Vindkast": "12",
     }
 
-    df = prep_data_from_user(input_dict)
+    df = prep_data_from_user(input_dict, impute=needs_imputation(best_model))
     prediction = best_model.predict(df)
 
     print(f"Prediction = {int(prediction[0])}")
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import pickle
+import platform
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+# artifacts are kept next to this file, so it does not matter where the app is started from.
+# Set CYCLE_ARTIFACT_ROOT to keep them somewhere else
+ARTIFACT_ROOT = os.environ.get(
+    "CYCLE_ARTIFACT_ROOT", str(Path(__file__).resolve().parent / "artifacts")
+)
+
+# loaded artifacts, by path, with the size/mtime of the file they were loaded from
+_LOADED = {}
+
+
+def library_versions() -> dict:
+    """
+    Returns the versions a pickle depends on, a pickled model can break when any of these change
+    """
+    return {
+        "python": ".".join(platform.python_version_tuple()[:2]),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "sklearn": sklearn.__version__,
+    }
+
+
+def raw_data_hash(directory: str) -> str:
+    """
+    Returns a sha256 of the florida and trafikkdata files in directory (names and contents),
+    or None if there are none, ex. when only the artifacts are deployed
+    """
+    if not os.path.isdir(directory):
+        return None
+
+    filenames = sorted(
+        entry.name
+        for entry in os.scandir(directory)
+        if "Florida" in entry.name or "trafikkdata" in entry.name
+    )
+    if not filenames:
+        return None
+
+    digest = hashlib.sha256()
+    for filename in filenames:
+        digest.update(filename.encode())
+        with open(f"{directory}/{filename}", "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+
+    return digest.hexdigest()
+
+
+class ArtifactManager:
+    """
+    Saves and loads pickled artifacts (the model, the imputer) under root.
+
+    Every artifact name.pkl has a manifest name.json with the sha256 of the pickle, the feature coloumns,
+    the hash of the data it was trained on and the library versions. An artifact is only loaded
+    if its manifest matches what the caller expects, otherwise load returns None and the caller rebuilds it.
+    """
+
+    def __init__(self, root: str = ARTIFACT_ROOT):
+        self.root = root
+
+    def path(self, name: str) -> str:
+        return f"{self.root}/{name}.pkl"
+
+    def manifest_path(self, name: str) -> str:
+        return f"{self.root}/{name}.json"
+
+    def _write_atomic(self, path: str, data: bytes) -> None:
+        """
+        Writes to a temp file in the same folder and renames it, so a reader sees the old file or the new one
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def save(
+        self, name: str, obj, feature_columns: list = None, data_hash: str = None, **extra
+    ) -> dict:
+        """
+        Input:
+            name: artifact name, saved as name.pkl
+            obj: anything that can be pickled
+            feature_columns: the coloumns obj expects, in order
+            data_hash: hash of the data obj was trained on, see raw_data_hash
+            extra: more fields to put in the manifest
+
+        The pickle is written before the manifest, so a manifest always describes a complete pickle.
+
+        Returns the manifest
+        """
+
+        os.makedirs(self.root, exist_ok=True)
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+        manifest = {
+            "name": name,
+            "type": type(obj).__name__,
+            "sha256": hashlib.sha256(data).hexdigest(),
+            "size_bytes": len(data),
+            "feature_columns": feature_columns,
+            "data_hash": data_hash,
+            "versions": library_versions(),
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            **extra,
+        }
+
+        self._write_atomic(self.path(name), data)
+        self._write_atomic(
+            self.manifest_path(name), json.dumps(manifest, indent=4).encode()
+        )
+        print(f"ARTIFACT : Saved {name} to {self.path(name)}")
+
+        return manifest
+
+    def manifest(self, name: str) -> dict:
+        """
+        Returns the manifest of an artifact, or None if it has none
+        """
+        try:
+            with open(self.manifest_path(name)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def problems(
+        self, manifest: dict, feature_columns: list = None, data_hash: str = None
+    ) -> list:
+        """
+        Returns the reasons the artifact described by manifest can not be used, an empty list if it can.
+        The data hash is only checked when both sides have one
+        """
+
+        if manifest is None:
+            return ["no manifest"]
+
+        problems = []
+
+        if manifest["versions"] != library_versions():
+            problems.append(
+                f"saved with {manifest['versions']}, running {library_versions()}"
+            )
+        if feature_columns is not None and manifest["feature_columns"] != list(
+            feature_columns
+        ):
+            problems.append("feature coloumns changed")
+        if (
+            data_hash is not None
+            and manifest["data_hash"] is not None
+            and manifest["data_hash"] != data_hash
+        ):
+            problems.append("trained on other data")
+
+        return problems
+
+    def load(self, name: str, feature_columns: list = None, data_hash: str = None):
+        """
+        Input:
+            name: artifact name
+            feature_columns/data_hash: what the artifact has to match, see problems
+
+        Loads an artifact if it is valid. The file is read once, and checked against the sha256 in the manifest
+        before it is unpickled. Loading the same unchanged file again returns the object already in memory.
+
+        Returns the object, or None if it is missing or not valid
+        """
+
+        path = self.path(name)
+        manifest = self.manifest(name)
+
+        problems = self.problems(manifest, feature_columns, data_hash)
+        if problems:
+            if os.path.exists(path):
+                print(f"ARTIFACT : Not using {path}: {', '.join(problems)}")
+            return None
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        key = (stat.st_size, stat.st_mtime_ns, manifest["sha256"])
+        if path in _LOADED and _LOADED[path][0] == key:
+            return _LOADED[path][1]
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        if hashlib.sha256(data).hexdigest() != manifest["sha256"]:
+            print(f"ARTIFACT : Not using {path}: file does not match its manifest")
+            return None
+
+        obj = pickle.loads(data)
+        _LOADED[path] = (key, obj)
+
+        return obj
@@ -0,0 +1,300 @@
+import asyncio
+import hmac
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import app as website
+
+# threads predicting at the same time, predictions hold the GIL for most of their time
+# so more threads than cpus only adds waiting
+MAX_PREDICT_THREADS = os.cpu_count()
+# predictions allowed to wait for a thread, requests after that get 503 right away
+MAX_QUEUED_PREDICTIONS = 256
+# largest request body read
+MAX_BODY_BYTES = 10 * 1024 * 1024
+
+executor = ThreadPoolExecutor(MAX_PREDICT_THREADS, thread_name_prefix="predict")
+_queued = None
+
+
+class RequestError(Exception):
+    """
+    A request that is answered with status (and message) instead of being handled
+    """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+async def run_prediction(function, *args, wait: bool = False):
+    """
+    Runs a (cpu bound) prediction in the executor, so the event loop keeps accepting connections.
+
+    Raises RequestError (503) if MAX_QUEUED_PREDICTIONS are already waiting, unless wait is True
+    (once a response has started it can not be changed to a 503)
+    """
+    global _queued
+    if _queued is None:
+        _queued = asyncio.Semaphore(MAX_PREDICT_THREADS + MAX_QUEUED_PREDICTIONS)
+    if _queued.locked() and not wait:
+        raise RequestError(503, "Too many predictions waiting, try again")
+
+    async with _queued:
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, function, *args
+        )
+
+
+async def read_body(receive) -> bytes:
+    """
+    Reads the whole request body, a slow client only holds up its own coroutine
+    """
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if len(body) > MAX_BODY_BYTES:
+            raise RequestError(413, "Request body too large")
+    return body
+
+
+async def send_response(
+    send, status: int, body, content_type: str = "application/json"
+) -> None:
+    if not isinstance(body, (bytes, str)):
+        body = json.dumps(body)
+    if isinstance(body, str):
+        body = body.encode()
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", content_type.encode()),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def render_home(messages: list = None, **context) -> str:
+    """
+    Renders home.html like flask's render_template, with messages as the flashed messages
+    """
+    if messages is None:
+        messages = []
+    template = website.app.jinja_env.get_template("home.html")
+    return template.render(get_flashed_messages=lambda: messages, **context)
+
+
+async def home(scope, receive) -> tuple:
+    """
+    The form of the website, see app.home
+    """
+    if scope["method"] != "POST":
+        return 200, render_home()
+
+    serving = website.models.get()
+    if serving is None:
+        message = (
+            "The model is warming up, please try again in a moment"
+            if website.models.error is None
+            else "ERROR: The model could not be loaded"
+        )
+        return 503, render_home([message])
+
+    input_dict = dict(parse_qsl((await read_body(receive)).decode()))
+    print(f" INPUT : {input_dict}")
+
+    prediction = await run_prediction(website.cached_prediction, serving, input_dict)
+    if prediction is None:
+        return 200, render_home(
+            [
+                "ERROR: Ensure all inputs types are numbers, and the date is in the proper format"
+            ]
+        )
+
+    trafficamount, traffic_range = prediction
+    trafficamount = int(trafficamount)
+
+    return 200, render_home(
+        traffic_data=trafficamount,
+        traffic_range=traffic_range,
+        **website.draw_cycle_art(trafficamount),
+    )
+
+
+async def api_predict(scope, receive, send) -> None:
+    """
+    Many hours in one request, see app.api_predict
+    """
+    serving = website.models.get()
+    if serving is None:
+        return await send_response(send, 503, website.models.status())
+
+    try:
+        body = json.loads(await read_body(receive) or b"null")
+        records = website.api_records(body)
+    except ValueError as e:
+        return await send_response(send, 400, {"error": str(e)})
+
+    query = dict(parse_qsl(scope.get("query_string", b"").decode()))
+    headers = dict(scope.get("headers", []))
+
+    if not (
+        query.get("stream")
+        or headers.get(b"accept", b"").startswith(b"application/x-ndjson")
+    ):
+        try:
+            rows = await run_prediction(
+                website.predict_rows, serving["predictor"], records
+            )
+        except (TypeError, ValueError) as e:
+            return await send_response(send, 400, {"error": str(e)})
+        return await send_response(send, 200, {"predictions": rows})
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/x-ndjson")],
+        }
+    )
+    # every chunk is predicted in the executor and sent before the next one is started.
+    # The status is already sent, so errors from here on end the stream with an error line
+    lines = website.stream_rows(serving["predictor"], records)
+    while True:
+        try:
+            chunk = await run_prediction(
+                lambda: "".join(
+                    next(lines, "") for _ in range(website.STREAM_CHUNK_ROWS)
+                ),
+                wait=True,
+            )
+        except Exception as e:
+            chunk = json.dumps({"error": str(e)}) + "\n"
+            await send(
+                {"type": "http.response.body", "body": chunk.encode(), "more_body": True}
+            )
+            break
+        if not chunk:
+            break
+        await send(
+            {"type": "http.response.body", "body": chunk.encode(), "more_body": True}
+        )
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def api_forecast(scope, receive, send) -> None:
+    """
+    Predicts every hour of a weather forecast sent as the body (text/csv), see app.api_forecast
+    """
+    serving = website.models.get()
+    if serving is None:
+        return await send_response(send, 503, website.models.status())
+
+    body = await read_body(receive)
+    if not body:
+        return await send_response(send, 400, {"error": "Send the forecast as text/csv"})
+
+    query = dict(parse_qsl(scope.get("query_string", b"").decode()))
+    try:
+        rows = await run_prediction(
+            website.forecast_request,
+            serving["predictor"],
+            io.BytesIO(body),
+            query.get("start"),
+            query.get("hours"),
+        )
+    except ValueError as e:
+        return await send_response(send, 400, {"error": str(e)})
+
+    await send_response(send, 200, {"forecast": rows})
+
+
+async def admin_reload(scope, send) -> None:
+    """
+    Reloads the model in the background, see app.admin_reload
+    """
+    token = dict(scope.get("headers", [])).get(b"x-admin-token", b"")
+    if website.ADMIN_TOKEN is None or not hmac.compare_digest(
+        token, website.ADMIN_TOKEN.encode()
+    ):
+        return await send_response(send, 404, {"error": "Not found"})
+
+    await send_response(
+        send, 202, {"reloading": website.models.reload(), **website.models.status()}
+    )
+
+
+async def lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            website.models.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            executor.shutdown(wait=False, cancel_futures=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send) -> None:
+    """
+    ASGI version of the flask app in app.py, with the same routes. Predictions run in a bounded
+    thread pool, so slow clients and slow predictions do not stop other connections from being served.
+
+    Run with any ASGI server, ex. uvicorn asgi:application --port 8080 (from the app folder)
+    """
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    # servers without lifespan support
+    website.models.start()
+    website.models.poll()
+
+    path = scope["path"]
+    try:
+        if path == "/":
+            status, page = await home(scope, receive)
+            return await send_response(send, status, page, "text/html; charset=utf-8")
+        if path == "/api/predict" and scope["method"] == "POST":
+            return await api_predict(scope, receive, send)
+        if path == "/healthz":
+            return await send_response(send, 200, {"status": "alive"})
+        if path == "/readyz":
+            status = website.models.status()
+            return await send_response(
+                send, 200 if status["status"] == "ready" else 503, status
+            )
+        if path == "/api/forecast" and scope["method"] == "POST":
+            return await api_forecast(scope, receive, send)
+        if path == "/admin/reload" and scope["method"] == "POST":
+            return await admin_reload(scope, send)
+        if path == "/cachez":
+            return await send_response(send, 200, website.prediction_cache.stats())
+        if path == "/batchz":
+            return await send_response(send, 200, website.micro_batcher.stats())
+    except RequestError as e:
+        return await send_response(send, e.status, {"error": str(e)})
+
+    await send_response(send, 404, {"error": "Not found"})
+
+
+if __name__ == "__main__":
+    """
+    Example: python app/asgi.py (needs uvicorn, pip install uvicorn)
+    """
+    import uvicorn
+
+    uvicorn.run(application, host="0.0.0.0", port=8080)
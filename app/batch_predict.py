@@ -0,0 +1,269 @@
+import argparse
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from appmodels import (
+    FEATURE_COLUMNS,
+    drop_uneeded_cols,
+    feauture_engineer,
+    model_artifact_name,
+    needs_imputation,
+    trim_transform_outliers,
+)
+from artifacts import ARTIFACT_ROOT, ArtifactManager
+from forest_engine import tree_predictions
+from joblib import Parallel, cpu_count, delayed
+
+# get current filepath to use when opening/saving files
+PWD = Path().absolute()
+
+# the weather files have one row every 10 minutes
+ROWS_PER_HOUR = 6
+
+
+def weather_files(source: str) -> list:
+    """
+    Returns the florida weather files in source, which is a file or a directory, sorted by name (and so by date)
+    """
+    if os.path.isfile(source):
+        return [source]
+    return sorted(
+        f"{source}/{entry.name}" for entry in os.scandir(source) if "Florida" in entry.name
+    )
+
+
+def set_florida_index(raw: pd.DataFrame) -> pd.DataFrame:
+    """
+    Replaces the Dato and Tid coloumns of florida rows with a DateFormatted index
+    """
+    raw.index = pd.to_datetime(raw["Dato"] + raw["Tid"], format="%Y-%m-%d%H:%M")
+    raw.index.name = "DateFormatted"
+    return raw.drop(columns=["Dato", "Tid"])
+
+
+def read_hour_chunks(files: list, start, end, chunk_hours: int):
+    """
+    Input:
+        files: florida weather files, in date order
+        start/end: only rows from start up to (not including) end are kept
+        chunk_hours: about how many hours each chunk has
+
+    Reads the files a chunk at a time. The rows of the last hour in a chunk are held back and put in
+    the next chunk, so an hour is never split between two chunks.
+
+    Yields dataframes of raw 10 minute rows, with the date as index
+    """
+
+    carry = None
+
+    for filename in files:
+        for raw in pd.read_csv(filename, chunksize=chunk_hours * ROWS_PER_HOUR):
+            raw = set_florida_index(raw)
+
+            if carry is not None:
+                raw = pd.concat([carry, raw])
+
+            last_hour = raw.index[-1].floor("H")
+            carry = raw[raw.index >= last_hour]
+            raw = raw[(raw.index < last_hour) & (raw.index >= start) & (raw.index < end)]
+
+            if len(raw):
+                yield raw
+
+            if last_hour >= end:
+                return
+
+    if carry is not None:
+        carry = carry[(carry.index >= start) & (carry.index < end)]
+        if len(carry):
+            yield carry
+
+
+def predict_weather(raw: pd.DataFrame, model) -> pd.DataFrame:
+    """
+    Input:
+        raw: weather rows (10 minute or hourly) in the florida layout, with the date as index
+        model: fitted model (or FlatForest)
+
+    Runs the rows through the same processing as the website, for all hours at once, and predicts every hour.
+    Forests also get the P10/P90 range across their trees.
+
+    Returns a dataframe with Dato, Tid and Prediksjon (like predictions.csv), with the date as index
+    """
+
+    # combine all 6 values for a given hour into its mean
+    df = raw.resample("H").mean()
+
+    df = trim_transform_outliers(df, True, impute=needs_imputation(model))
+    df = feauture_engineer(df, True)
+    df = drop_uneeded_cols(df)
+    X = df[FEATURE_COLUMNS]
+
+    predictions = pd.DataFrame(
+        {"Dato": df.index.date, "Tid": df.index.hour}, index=df.index
+    )
+
+    trees = tree_predictions(model, X)
+    if trees is not None:
+        predictions["Prediksjon"] = trees.mean(axis=1)
+        predictions["Prediksjon_P10"], predictions["Prediksjon_P90"] = np.percentile(
+            trees, [10, 90], axis=1
+        )
+    else:
+        predictions["Prediksjon"] = model.predict(X)
+
+    # make predictions to ints as float number of cyclists makes no sense.
+    prediction_cols = [col for col in predictions.columns if col.startswith("Prediksjon")]
+    predictions[prediction_cols] = predictions[prediction_cols].astype(int)
+
+    return predictions
+
+
+def predict_chunk(raw: pd.DataFrame, model_name: str, root: str) -> pd.DataFrame:
+    """
+    Input:
+        raw: 10 minute weather rows, see read_hour_chunks
+        model_name/root: the model artifact, every worker only loads it once (see ArtifactManager.load)
+
+    Returns the predictions for every hour in the chunk, see predict_weather
+    """
+
+    model = ArtifactManager(root).load(model_name, FEATURE_COLUMNS)
+    if model is None:
+        raise FileNotFoundError(f"No valid model artifact {model_name} in {root}")
+
+    return predict_weather(raw, model)
+
+
+class PredictionWriter:
+    """
+    Appends predictions to a .csv or .parquet file one chunk at a time.
+    Parquet needs pyarrow to be installed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.parquet = path.endswith(".parquet")
+        self.rows = 0
+        self._parquet_writer = None
+
+    def write(self, predictions: pd.DataFrame) -> None:
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(predictions)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.path, table.schema)
+            self._parquet_writer.write_table(table)
+        else:
+            predictions.to_csv(
+                self.path, mode="w" if self.rows == 0 else "a", header=self.rows == 0
+            )
+
+        self.rows += len(predictions)
+
+    def close(self) -> None:
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+
+
+def batch_predict(
+    weather: str,
+    start: str,
+    end: str,
+    output: str,
+    model_name: str = None,
+    root: str = ARTIFACT_ROOT,
+    chunk_hours: int = 24 * 30,
+    n_workers: int = None,
+) -> int:
+    """
+    Input:
+        weather: florida weather file, or a directory of them
+        start/end: predict every hour from start up to (not including) end
+        output: .csv or .parquet file to write the predictions to
+        model_name: the model artifact, the best model (see model_artifact_name) if None
+        root: the artifact folder
+        chunk_hours: hours per chunk, memory use grows with chunk_hours * n_workers
+        n_workers: number of processes to use, defaults to one per cpu
+
+    Streams the weather through fixed size chunks that are predicted by a pool of workers, and appends
+    the predictions to output in date order as they finish. Only a few chunks are in memory at any time.
+
+    Returns the number of hours predicted
+    """
+
+    if model_name is None:
+        model_name = model_artifact_name()
+
+    artifacts = ArtifactManager(root)
+    problems = artifacts.problems(artifacts.manifest(model_name), FEATURE_COLUMNS)
+    if problems or not os.path.exists(artifacts.path(model_name)):
+        raise FileNotFoundError(
+            f"No valid model at {artifacts.path(model_name)}: {', '.join(problems)}"
+        )
+    if n_workers is None:
+        n_workers = cpu_count()
+
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    chunks = read_hour_chunks(weather_files(weather), start, end, chunk_hours)
+
+    print(
+        f"INFO : Predicting {start} to {end} in chunks of {chunk_hours} hours on {n_workers} workers"
+    )
+
+    start_time = time.perf_counter()
+    writer = PredictionWriter(output)
+
+    try:
+        # the generator hands out chunks as workers free up, and returns the results in order
+        results = Parallel(
+            n_jobs=n_workers, return_as="generator", pre_dispatch="2*n_jobs"
+        )(delayed(predict_chunk)(raw, model_name, root) for raw in chunks)
+        for predictions in results:
+            writer.write(predictions)
+            print(f"INFO : Wrote {writer.rows} hours, up to {predictions.index[-1]}")
+    finally:
+        writer.close()
+
+    print(
+        f"INFO : Predicted {writer.rows} hours to {output} in {round(time.perf_counter() - start_time, 2)} seconds"
+    )
+    return writer.rows
+
+
+if __name__ == "__main__":
+    """
+    Example: python app/batch_predict.py 2023-01-01 2023-07-01 --weather src/raw_data --output out/predictions_2023.csv
+    """
+    parser = argparse.ArgumentParser(
+        description="Predict cycle traffic for a range of dates"
+    )
+    parser.add_argument("start", help="first date to predict, ex 2023-01-01")
+    parser.add_argument("end", help="date to stop at (not included), ex 2023-07-01")
+    parser.add_argument(
+        "--weather", default=f"{PWD}/src/raw_data", help="florida weather file or directory"
+    )
+    parser.add_argument(
+        "--output", default=f"{PWD}/out/predictions.csv", help=".csv or .parquet"
+    )
+    parser.add_argument("--model", default=None, help="model artifact name")
+    parser.add_argument("--artifacts", default=ARTIFACT_ROOT, help="artifact folder")
+    parser.add_argument("--chunk-hours", type=int, default=24 * 30)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    batch_predict(
+        args.weather,
+        args.start,
+        args.end,
+        args.output,
+        args.model,
+        args.artifacts,
+        args.chunk_hours,
+        args.workers,
+    )
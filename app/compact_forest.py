@@ -0,0 +1,338 @@
+import json
+import os
+import pickle
+import shutil
+import time
+from math import sqrt
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from forest_engine import FlatForest
+from sklearn.ensemble import RandomForestRegressor
+
+# get current filepath to use when opening/saving files
+PWD = Path().absolute()
+RANDOM_STATE = 2
+
+COMPACT_MODEL_DIR = f"{PWD}/app/compact_model"
+
+# arrays of a flattened forest, saved as one .npy file each
+ARRAY_NAMES = ["feature", "threshold", "left", "right", "value", "roots"]
+
+
+def round_down(values: np.ndarray, dtype: type) -> np.ndarray:
+    """
+    Converts values to dtype, rounding down instead of to the nearest value.
+
+    Inputs are float32, and for a float32 x, x <= threshold is the same as x <= threshold
+    rounded down to float32. So float32 thresholds give the exact same splits as the float64 ones.
+    """
+    converted = values.astype(dtype)
+    too_big = converted > values
+    converted[too_big] = np.nextafter(converted[too_big], dtype(-np.inf))
+    return converted
+
+
+def flatten_forest(
+    estimators: list,
+    threshold_dtype: type = np.float32,
+    value_dtype: type = np.float32,
+) -> dict:
+    """
+    Input:
+        estimators: the fitted trees of a forest (model.estimators_)
+        threshold_dtype/value_dtype: dtype to store split thresholds and leaf values in
+
+    Puts the nodes of every tree after eachother in flat arrays:
+        feature: the coloumn a node splits on (0 for leaves)
+        threshold: go left if x[feature] <= threshold
+        left/right: position of the child nodes in the flat arrays, leaves point to themselves
+        value: the prediction of a leaf
+        roots: position of the root node of every tree
+
+    Returns a dict of name -> array
+    """
+
+    features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+    offset = 0
+
+    for estimator in estimators:
+        tree = estimator.tree_
+        is_leaf = tree.children_left == -1
+        node_ids = np.arange(tree.node_count) + offset
+
+        roots.append(offset)
+        features.append(np.where(is_leaf, 0, tree.feature))
+        thresholds.append(tree.threshold)
+        lefts.append(np.where(is_leaf, node_ids, tree.children_left + offset))
+        rights.append(np.where(is_leaf, node_ids, tree.children_right + offset))
+        values.append(tree.value[:, 0, 0])
+
+        offset += tree.node_count
+
+    return {
+        "feature": np.concatenate(features).astype(np.int32),
+        "threshold": round_down(np.concatenate(thresholds), threshold_dtype),
+        "left": np.concatenate(lefts).astype(np.int32),
+        "right": np.concatenate(rights).astype(np.int32),
+        "value": np.concatenate(values).astype(value_dtype),
+        "roots": np.asarray(roots, dtype=np.int32),
+    }
+
+
+def save_compact_forest(
+    arrays: dict, directory: str = COMPACT_MODEL_DIR, model_sha256: str = None
+) -> None:
+    """
+    Saves a flattened forest as uncompressed .npy files, which can be memory mapped when loading.
+    The files are written to a temp folder first, so a half written model is never loaded.
+    model_sha256 is the sha256 of the model artifact it was made from (see artifacts.py)
+    """
+
+    tmp_directory = f"{directory}.tmp"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+
+    for name in ARRAY_NAMES:
+        np.save(f"{tmp_directory}/{name}.npy", np.ascontiguousarray(arrays[name]))
+
+    with open(f"{tmp_directory}/meta.json", "w") as f:
+        json.dump(
+            {
+                "n_trees": len(arrays["roots"]),
+                "n_nodes": len(arrays["feature"]),
+                "threshold_dtype": str(arrays["threshold"].dtype),
+                "value_dtype": str(arrays["value"].dtype),
+                "model_sha256": model_sha256,
+            },
+            f,
+        )
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+
+
+def load_compact_forest(directory: str = COMPACT_MODEL_DIR) -> FlatForest:
+    """
+    Loads a forest saved with save_compact_forest. The arrays are memory mapped,
+    so nothing is read from disk until a prediction needs it
+    """
+    arrays = {
+        name: np.load(f"{directory}/{name}.npy", mmap_mode="r") for name in ARRAY_NAMES
+    }
+    return FlatForest(arrays)
+
+
+def compact_model_sha256(directory: str = COMPACT_MODEL_DIR) -> str:
+    """
+    Returns the sha256 of the model artifact the saved compact forest was made from,
+    None if it is not known (or nothing is saved)
+    """
+    try:
+        with open(f"{directory}/meta.json") as f:
+            return json.load(f).get("model_sha256")
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def prune_trees(model: RandomForestRegressor, X_val, y_val, n_trees: int) -> list:
+    """
+    Input:
+        model: fitted forest
+        X_val/y_val: data to judge the trees on
+        n_trees: how many trees to keep
+
+    Picks trees one at a time, each time adding the tree that lowers the validation MSE
+    of the trees picked so far the most.
+
+    Returns the picked trees
+    """
+
+    X_val = np.ascontiguousarray(X_val, dtype=np.float32)
+    y_val = np.asarray(y_val, dtype=np.float64)
+
+    # every trees predictions, only computed once
+    tree_predictions = np.stack(
+        [tree.predict(X_val, check_input=False) for tree in model.estimators_]
+    )
+
+    picked = []
+    prediction_sum = np.zeros(len(y_val))
+    available = np.ones(len(tree_predictions), dtype=bool)
+
+    for n_picked in range(min(n_trees, len(tree_predictions))):
+        candidate_mse = (
+            ((prediction_sum + tree_predictions) / (n_picked + 1) - y_val) ** 2
+        ).mean(axis=1)
+        candidate_mse[~available] = np.inf
+
+        best = int(np.argmin(candidate_mse))
+        picked.append(model.estimators_[best])
+        prediction_sum += tree_predictions[best]
+        available[best] = False
+
+    return picked
+
+
+def directory_size(directory: str) -> int:
+    """
+    Returns the size of all files in a directory in bytes
+    """
+    return sum(entry.stat().st_size for entry in os.scandir(directory))
+
+
+def time_model(load, X_val, y_val, n_single_rows: int = 200) -> dict:
+    """
+    Input:
+        load: function that loads the model
+        X_val/y_val: data to predict on
+
+    Returns the load time, single row predict latency and RMSE of the model
+    """
+
+    start_time = time.perf_counter()
+    model = load()
+    load_seconds = time.perf_counter() - start_time
+
+    single_row_ms = []
+    for i in range(min(n_single_rows, len(X_val))):
+        start_time = time.perf_counter()
+        model.predict(X_val[i : i + 1])
+        single_row_ms.append((time.perf_counter() - start_time) * 1000)
+
+    rmse = sqrt(np.mean((model.predict(X_val) - y_val) ** 2))
+
+    return {
+        "load_seconds": round(load_seconds, 4),
+        "single_row_p50_ms": round(np.percentile(single_row_ms, 50), 3),
+        "single_row_p99_ms": round(np.percentile(single_row_ms, 99), 3),
+        "rmse": rmse,
+    }
+
+
+def compaction_report(
+    model: RandomForestRegressor,
+    X_train,
+    y_train,
+    X_val,
+    y_val,
+    max_depth: int = 20,
+    min_samples_leaf: int = 2,
+    n_trees: int = 60,
+    prune_fraction: float = 0.2,
+    directory: str = f"{PWD}/app/compact_report",
+) -> pd.DataFrame:
+    """
+    Input:
+        model: the full forest
+        X_train/y_train: training data, used to refit the forest with depth/leaf limits
+        X_val/y_val: data to compare the models with
+        max_depth/min_samples_leaf: limits for the refitted forest
+        n_trees: trees kept when pruning
+        prune_fraction: the last part of the training data the pruned trees are picked on,
+                        so the pruned forest is not judged on the data it was picked with
+
+    Saves different compactions of the forest and compares their size, load time,
+    predict latency and RMSE with the full pickled forest.
+
+    Returns a dataframe with one row per compaction
+    """
+
+    X_val = np.ascontiguousarray(X_val, dtype=np.float32)
+    y_val = np.asarray(y_val, dtype=np.float64)
+    os.makedirs(directory, exist_ok=True)
+
+    n_prune = max(1, int(len(X_train) * prune_fraction))
+    X_prune = np.asarray(X_train, dtype=np.float32)[-n_prune:]
+    y_prune = np.asarray(y_train, dtype=np.float64)[-n_prune:]
+
+    variants = {
+        "float32": (model.estimators_, np.float32, np.float32),
+        "float16": (model.estimators_, np.float16, np.float16),
+        f"pruned_{n_trees}_float32": (
+            prune_trees(model, X_prune, y_prune, n_trees),
+            np.float32,
+            np.float32,
+        ),
+    }
+
+    print(f"COMPACT : Refitting forest with max_depth={max_depth}, min_samples_leaf={min_samples_leaf}")
+    limited = RandomForestRegressor(
+        n_estimators=len(model.estimators_),
+        max_depth=max_depth,
+        min_samples_leaf=min_samples_leaf,
+        random_state=RANDOM_STATE,
+    ).fit(np.asarray(X_train, dtype=np.float32), y_train)
+    variants[f"depth_{max_depth}_leaf_{min_samples_leaf}_float32"] = (
+        limited.estimators_,
+        np.float32,
+        np.float32,
+    )
+
+    # the full forest, as the app loads it today
+    full_path = f"{directory}/full_model.pkl"
+    with open(full_path, "wb") as f:
+        pickle.dump(model, f)
+
+    def load_full():
+        with open(full_path, "rb") as f:
+            return pickle.load(f)
+
+    rows = [
+        {
+            "variant": "full_pickle",
+            "size_mb": os.path.getsize(full_path) / 1e6,
+            **time_model(load_full, X_val, y_val),
+        }
+    ]
+
+    for name, (estimators, threshold_dtype, value_dtype) in variants.items():
+        print(f"COMPACT : Saving {name}")
+        variant_directory = f"{directory}/{name}"
+        save_compact_forest(
+            flatten_forest(estimators, threshold_dtype, value_dtype), variant_directory
+        )
+        rows.append(
+            {
+                "variant": name,
+                "size_mb": directory_size(variant_directory) / 1e6,
+                **time_model(
+                    lambda: load_compact_forest(variant_directory), X_val, y_val
+                ),
+            }
+        )
+
+    report = pd.DataFrame(rows)
+    report["size_mb"] = report["size_mb"].round(2)
+    report["rmse_delta"] = report["rmse"] - report["rmse"].iloc[0]
+
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(report)
+
+    return report
+
+
+if __name__ == "__main__":
+    """
+    Compares compactions of the best model, and saves the float32 one for the app to load
+    """
+    from appmodels import (
+        build_training_data,
+        load_best_model,
+        load_validation_data,
+        model_artifact_name,
+    )
+    from artifacts import ArtifactManager
+
+    best_model = load_best_model()
+    manifest = ArtifactManager().manifest(model_artifact_name())
+    X_train, y_train = build_training_data()
+    X_val, y_val = load_validation_data()
+
+    compaction_report(best_model, X_train, y_train, X_val, y_val)
+
+    save_compact_forest(
+        flatten_forest(best_model.estimators_), model_sha256=manifest["sha256"]
+    )
+    print(f"COMPACT : Saved compact model to {COMPACT_MODEL_DIR}")
@@ -0,0 +1,111 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+from appmodels import FEATURE_COLUMNS, INPUT_COLUMNS, model_artifact_name
+from artifacts import ARTIFACT_ROOT, ArtifactManager
+from batch_predict import predict_weather, set_florida_index
+
+FORECAST_HOURS = 48
+# longest forecast predicted in one request
+MAX_FORECAST_HOURS = 24 * 14
+
+
+def read_forecast(source) -> pd.DataFrame:
+    """
+    Input:
+        source: path or file object of a weather forecast in the florida layout
+                (Dato, Tid and the weather coloumns), hourly or every 10 minutes.
+                Weather coloumns the forecast does not have are imputed
+
+    Raises ValueError if the file has no rows, or no Dato and Tid coloumns
+
+    Returns the weather rows with the date as index
+    """
+    raw = pd.read_csv(source, encoding="utf-8-sig")
+
+    if raw.empty:
+        raise ValueError("The forecast has no rows")
+    if "Dato" not in raw.columns or "Tid" not in raw.columns:
+        raise ValueError("The forecast needs Dato and Tid coloumns, like the florida files")
+
+    for col in INPUT_COLUMNS:
+        if col not in raw.columns:
+            raw[col] = np.nan
+
+    # in the order the imputer was fitted on
+    raw = raw[["Dato", "Tid"] + INPUT_COLUMNS]
+
+    return set_florida_index(raw).sort_index()
+
+
+def forecast(
+    raw: pd.DataFrame, model, start: str = None, hours: int = FORECAST_HOURS
+) -> pd.DataFrame:
+    """
+    Input:
+        raw: weather forecast rows, see read_forecast
+        model: fitted model (or FlatForest)
+        start: first hour to predict, the first hour of the forecast if None
+        hours: number of hours to predict, at most MAX_FORECAST_HOURS
+
+    Computes the features for the whole horizon at once and predicts it in one batch, without going
+    through prep_data_from_user hour by hour. The model has no rolling (lag) features, so every hour
+    only depends on its own weather and time.
+
+    Returns a dataframe with Prediksjon (and for forests Prediksjon_P10/P90) for every hour, with the date as index
+    """
+    if not 0 < hours <= MAX_FORECAST_HOURS:
+        raise ValueError(f"hours has to be between 1 and {MAX_FORECAST_HOURS}")
+
+    start = raw.index[0].floor("H") if start is None else pd.Timestamp(start)
+    end = start + pd.Timedelta(hours=hours)
+
+    raw = raw[(raw.index >= start) & (raw.index < end)]
+    if raw.empty:
+        raise ValueError(f"The forecast has no weather from {start} to {end}")
+
+    return predict_weather(raw, model).drop(columns=["Dato", "Tid"])
+
+
+def forecast_rows(predictions: pd.DataFrame) -> list:
+    """
+    Returns the forecast as a list of dicts like /api/predict answers
+    """
+    columns = {
+        "Prediksjon": "prediction",
+        "Prediksjon_P10": "p10",
+        "Prediksjon_P90": "p90",
+    }
+    rows = predictions.rename(columns=columns)
+    rows = rows[[col for col in columns.values() if col in rows.columns]]
+    rows.insert(0, "DateFormatted", rows.index.strftime("%Y-%m-%d %H:%M:%S"))
+
+    return rows.to_dict(orient="records")
+
+
+if __name__ == "__main__":
+    """
+    Example: python app/forecast.py forecast.csv --hours 48 --output out/forecast.csv
+    """
+    parser = argparse.ArgumentParser(
+        description="Predict cycle traffic for the hours of a weather forecast"
+    )
+    parser.add_argument("weather", help="weather forecast in the florida layout")
+    parser.add_argument("--start", default=None, help="first hour, ex 2023-06-01 00:00")
+    parser.add_argument("--hours", type=int, default=FORECAST_HOURS)
+    parser.add_argument("--output", default=None, help="csv to write, printed if not set")
+    parser.add_argument("--artifacts", default=ARTIFACT_ROOT, help="artifact folder")
+    args = parser.parse_args()
+
+    model = ArtifactManager(args.artifacts).load(model_artifact_name(), FEATURE_COLUMNS)
+    if model is None:
+        raise FileNotFoundError(f"No valid model artifact in {args.artifacts}")
+
+    predictions = forecast(read_forecast(args.weather), model, args.start, args.hours)
+
+    if args.output is None:
+        print(predictions.to_string())
+    else:
+        predictions.to_csv(args.output)
+        print(f"INFO : Wrote {len(predictions)} hours to {args.output}")
@@ -0,0 +1,162 @@
+import time
+
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+
+# rows are walked down the trees this many at a time, to keep the node arrays small
+CHUNK_ROWS = 4096
+
+
+class FlatForest:
+    """
+    A forest flattened to contiguous node arrays (see compact_forest.flatten_forest),
+    which predicts every (row, tree) pair at the same time with numpy instead of
+    going through sklearn's input checks and joblib for every call.
+
+    Leaves point to themselves, and each step only moves the pairs that have not reached a leaf yet.
+
+    This is made for the website, which predicts one row at a time. For big batches
+    sklearn's compiled tree code is still faster, see benchmark_engine.
+    """
+
+    def __init__(self, arrays: dict):
+        self.feature = arrays["feature"]
+        self.threshold = arrays["threshold"]
+        self.left = arrays["left"]
+        self.right = arrays["right"]
+        self.value = arrays["value"]
+        self.roots = arrays["roots"]
+        self.n_estimators = len(self.roots)
+
+    @classmethod
+    def from_forest(
+        cls, model: RandomForestRegressor, value_dtype: type = np.float64
+    ) -> "FlatForest":
+        """
+        Flattens a fitted RandomForestRegressor. Thresholds are float32 rounded down, which
+        gives the same splits as sklearn, and values are float64 so predictions match sklearn
+        """
+        # imported here, compact_forest imports this module
+        from compact_forest import flatten_forest
+
+        return cls(flatten_forest(model.estimators_, np.float32, value_dtype))
+
+    def predict_trees(self, X) -> np.ndarray:
+        """
+        Returns every trees prediction for every row in X, as an array of shape (rows, trees)
+        """
+
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        n_features = X.shape[1]
+        predictions = np.empty((len(X), self.n_estimators), dtype=np.float64)
+
+        for start in range(0, len(X), CHUNK_ROWS):
+            X_chunk = X[start : start + CHUNK_ROWS].ravel()
+            n_rows = len(X_chunk) // n_features
+
+            # one node per (row, tree) pair, everyone starts at their trees root
+            node = np.tile(self.roots, n_rows)
+            row_offset = np.repeat(np.arange(n_rows) * n_features, self.n_estimators)
+
+            # the pairs that have not reached a leaf yet, only these are moved each step
+            active = np.arange(len(node))
+
+            while len(active):
+                current = node[active]
+                left = self.left[current]
+                right = self.right[current]
+
+                # only leaves point both ways to the same node
+                not_leaf = left != right
+                if not not_leaf.all():
+                    active = active[not_leaf]
+                    current = current[not_leaf]
+                    left = left[not_leaf]
+                    right = right[not_leaf]
+
+                x = X_chunk[row_offset[active] + self.feature[current]]
+                node[active] = np.where(x <= self.threshold[current], left, right)
+
+            predictions[start : start + n_rows] = self.value[node].reshape(
+                n_rows, self.n_estimators
+            )
+
+        return predictions
+
+    def predict(self, X) -> np.ndarray:
+        """
+        Returns the mean of the trees predictions for every row in X, like RandomForestRegressor
+        """
+        return self.predict_trees(X).mean(axis=1)
+
+
+def tree_predictions(model, X) -> np.ndarray:
+    """
+    Returns every trees prediction for every row in X, as an array of shape (rows, trees),
+    for a FlatForest or a RandomForestRegressor. Returns None for other models
+    """
+    if isinstance(model, FlatForest):
+        return model.predict_trees(X)
+
+    if isinstance(model, RandomForestRegressor):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        return np.stack(
+            [tree.predict(X, check_input=False) for tree in model.estimators_], axis=1
+        )
+
+    return None
+
+
+def benchmark_engine(
+    model: RandomForestRegressor, X, n_single_rows: int = 1000, n_batch_runs: int = 3
+) -> dict:
+    """
+    Input:
+        model: fitted forest
+        X: rows to predict on
+        n_single_rows: how many single row predictions to time
+        n_batch_runs: how many times to time predicting all of X
+
+    Compares single row latency (p50/p99) and batch throughput of sklearn and FlatForest,
+    and checks they predict the same.
+
+    Returns a dict with the results
+    """
+
+    engine = FlatForest.from_forest(model)
+    X = np.ascontiguousarray(X, dtype=np.float32)
+
+    max_difference = float(np.abs(engine.predict(X) - model.predict(X)).max())
+
+    results = {"max_abs_difference": max_difference}
+
+    for name, predictor in [("sklearn", model), ("flat", engine)]:
+        single_row_ms = []
+        for i in range(min(n_single_rows, len(X))):
+            start_time = time.perf_counter()
+            predictor.predict(X[i : i + 1])
+            single_row_ms.append((time.perf_counter() - start_time) * 1000)
+
+        start_time = time.perf_counter()
+        for _ in range(n_batch_runs):
+            predictor.predict(X)
+        batch_seconds = (time.perf_counter() - start_time) / n_batch_runs
+
+        results[f"{name}_single_row_p50_ms"] = round(np.percentile(single_row_ms, 50), 4)
+        results[f"{name}_single_row_p99_ms"] = round(np.percentile(single_row_ms, 99), 4)
+        results[f"{name}_batch_rows_per_second"] = round(len(X) / batch_seconds)
+
+    for key, value in results.items():
+        print(f"BENCHMARK : {key} = {value}")
+
+    return results
+
+
+if __name__ == "__main__":
+    """
+    Benchmarks the flattened forest against the sklearn forest on the validation data
+    """
+    from appmodels import load_best_model, load_validation_data
+
+    X_val, y_val = load_validation_data()
+    benchmark_engine(load_best_model(), X_val)
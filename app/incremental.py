@@ -0,0 +1,206 @@
+import argparse
+import copy
+import os
+from math import sqrt
+
+import numpy as np
+import pandas as pd
+from appmodels import (
+    FEATURE_COLUMNS,
+    current_data_hash,
+    drop_uneeded_cols,
+    feauture_engineer,
+    merge_frames,
+    model_artifact_name,
+    normalize_data,
+    treat_florida_files,
+    treat_trafikk_files,
+    trim_transform_outliers,
+)
+from artifacts import ARTIFACT_ROOT, ArtifactManager, raw_data_hash
+from sklearn.ensemble import RandomForestRegressor
+
+# "grow" adds trees trained on the new data, "rolling" also drops as many of the oldest trees
+UPDATE_MODES = ["grow", "rolling"]
+
+
+def parse_new_data(directory: str) -> (pd.DataFrame, pd.Series):
+    """
+    Input: directory with only the new florida and trafikkdata files
+
+    Runs the new files through the same processing as build_training_data. Missing values are
+    filled by the saved imputer, so the history is not parsed or imputed again.
+
+    Returns X_new, y_new sorted by date, with the coloumns in FEATURE_COLUMNS order
+    """
+
+    florida_df_list = []
+    trafikk_df = None
+
+    for filename in os.scandir(directory):
+        if "Florida" in str(filename):
+            florida_df_list.append(treat_florida_files(f"{directory}/{filename.name}"))
+
+        if "trafikkdata" in str(filename):
+            trafikk_df = treat_trafikk_files(f"{directory}/{filename.name}")
+
+    if not florida_df_list or trafikk_df is None:
+        raise FileNotFoundError(
+            f"{directory} needs both Florida and trafikkdata files to update the model"
+        )
+
+    _, df = merge_frames([pd.concat(florida_df_list, axis=0), trafikk_df])
+    print(f"INFO : Parsed {len(df)} new rows from {directory}")
+
+    df = trim_transform_outliers(df, False)
+    df = feauture_engineer(df, False)
+    df = normalize_data(df)
+    df = drop_uneeded_cols(df)
+    df = df.sort_index()
+
+    return df[FEATURE_COLUMNS], df["Total_trafikk"]
+
+
+def split_recent(X: pd.DataFrame, y: pd.Series, holdout_fraction: float) -> tuple:
+    """
+    Splits the data by date, the most recent holdout_fraction of the rows is held out for validation
+
+    Returns X_fit, y_fit, X_holdout, y_holdout
+    """
+    n_fit = int(len(X) * (1 - holdout_fraction))
+    return X.iloc[:n_fit], y.iloc[:n_fit], X.iloc[n_fit:], y.iloc[n_fit:]
+
+
+def update_forest(
+    model: RandomForestRegressor, X_new, y_new, n_new_trees: int, mode: str = "grow"
+) -> RandomForestRegressor:
+    """
+    Input:
+        model: fitted forest, it is not changed
+        X_new/y_new: data the new trees are trained on
+        n_new_trees: how many trees to train
+        mode: see UPDATE_MODES
+
+    The new trees are added with warm_start, which gives them new seeds and leaves the old trees as they are.
+    Trees are kept oldest first, so "rolling" drops the first n_new_trees of them, and the forest keeps its size.
+
+    Returns the updated forest
+    """
+
+    if not isinstance(model, RandomForestRegressor):
+        raise ValueError(
+            f"Incremental updates need a RandomForestRegressor, not {type(model).__name__}"
+        )
+    if mode not in UPDATE_MODES:
+        raise ValueError(f"Unknown update mode '{mode}', use one of {UPDATE_MODES}")
+
+    updated = copy.deepcopy(model)
+    updated.set_params(warm_start=True, n_estimators=len(model.estimators_) + n_new_trees)
+    updated.fit(X_new, y_new)
+
+    if mode == "rolling":
+        updated.estimators_ = updated.estimators_[n_new_trees:]
+        updated.n_estimators = len(updated.estimators_)
+
+    updated.set_params(warm_start=False)
+    return updated
+
+
+def rmse(model, X, y) -> float:
+    """
+    Returns the RMSE of the model on X, y
+    """
+    return sqrt(np.mean((model.predict(X) - np.asarray(y)) ** 2))
+
+
+def publish_model(model, directory: str, root: str = ARTIFACT_ROOT) -> None:
+    """
+    Saves the updated model as the best model artifact (written atomically, see artifacts.ArtifactManager).
+    The manifest keeps the hash of the raw data, so the app still accepts it, and the hash of the new data
+    in "updated_with"
+    """
+    ArtifactManager(root).save(
+        model_artifact_name(),
+        model,
+        FEATURE_COLUMNS,
+        current_data_hash(),
+        updated_with=raw_data_hash(directory),
+    )
+
+
+def incremental_update(
+    directory: str,
+    mode: str = "grow",
+    n_new_trees: int = 30,
+    holdout_fraction: float = 0.2,
+    tolerance: float = 0.05,
+    root: str = ARTIFACT_ROOT,
+) -> dict:
+    """
+    Input:
+        directory: folder with only the new florida and trafikkdata files
+        mode/n_new_trees: see update_forest
+        holdout_fraction: the most recent part of the new data, only used to validate
+        tolerance: the updated model is published if its holdout RMSE is at most this much worse
+                   (as a fraction) than the current model's
+
+    Updates the current model with the new data, and publishes it if it holds up on the recent holdout.
+
+    Returns a dict with the holdout RMSE of both models and whether the update was published
+    """
+
+    X_new, y_new = parse_new_data(directory)
+    X_fit, y_fit, X_holdout, y_holdout = split_recent(X_new, y_new, holdout_fraction)
+
+    # the model that is replaced, from the same artifact folder the update is published to
+    artifacts = ArtifactManager(root)
+    current = artifacts.load(model_artifact_name(), FEATURE_COLUMNS, current_data_hash())
+    if current is None:
+        raise FileNotFoundError(
+            f"No valid model to update at {artifacts.path(model_artifact_name())}"
+        )
+    print(
+        f"MODELS : Updating {len(current.estimators_)} trees ({mode}) with {n_new_trees} trees on {len(X_fit)} rows"
+    )
+    updated = update_forest(current, X_fit, y_fit, n_new_trees, mode)
+
+    result = {
+        "holdout_rows": len(X_holdout),
+        "current_rmse": rmse(current, X_holdout, y_holdout),
+        "updated_rmse": rmse(updated, X_holdout, y_holdout),
+        "n_trees": len(updated.estimators_),
+    }
+    result["published"] = result["updated_rmse"] <= result["current_rmse"] * (1 + tolerance)
+
+    for key, value in result.items():
+        print(f"MODELS : {key} = {value}")
+
+    if result["published"]:
+        publish_model(updated, directory, root)
+    else:
+        print("MODELS : Updated model is worse on the recent holdout, keeping the current model")
+
+    return result
+
+
+if __name__ == "__main__":
+    """
+    Example: python app/incremental.py new_data/ --mode rolling --trees 30
+    """
+    parser = argparse.ArgumentParser(
+        description="Update the model with new traffic data"
+    )
+    parser.add_argument(
+        "directory", help="folder with only the new florida and trafikkdata files"
+    )
+    parser.add_argument("--mode", choices=UPDATE_MODES, default="grow")
+    parser.add_argument("--trees", type=int, default=30, help="number of new trees")
+    parser.add_argument(
+        "--holdout", type=float, default=0.2, help="fraction of the newest rows to validate on"
+    )
+    parser.add_argument("--tolerance", type=float, default=0.05)
+    args = parser.parse_args()
+
+    incremental_update(
+        args.directory, args.mode, args.trees, args.holdout, args.tolerance
+    )
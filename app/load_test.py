@@ -0,0 +1,123 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app as website
+import numpy as np
+import pandas as pd
+from appmodels import INPUT_COLUMNS
+
+# ranges the random weather inputs are drawn from
+INPUT_RANGES = {
+    "Globalstraling": (0, 800),
+    "Solskinstid": (0, 10),
+    "Lufttemperatur": (-10, 30),
+    "Vindretning": (0, 360),
+    "Vindstyrke": (0, 15),
+    "Lufttrykk": (970, 1040),
+    "Vindkast": (0, 25),
+}
+
+
+def random_inputs(n: int, seed: int = 2) -> list:
+    """
+    Returns n different website inputs (as the form sends them), for random hours of 2023
+    """
+    rng = np.random.RandomState(seed)
+    dates = pd.Timestamp("2023-01-01") + pd.to_timedelta(
+        rng.randint(0, 365 * 24, n), unit="h"
+    )
+
+    inputs = []
+    for i in range(n):
+        input_dict = {"DateFormatted": dates[i].strftime("%Y-%m-%d %H:%M:%S")}
+        for col in INPUT_COLUMNS:
+            low, high = INPUT_RANGES[col]
+            input_dict[col] = str(round(rng.uniform(low, high), 1))
+        inputs.append(input_dict)
+
+    return inputs
+
+
+def run_clients(serving: dict, inputs: list, n_clients: int) -> dict:
+    """
+    Sends every input through the website's prediction path from n_clients threads at once
+
+    Returns the throughput and latency percentiles
+    """
+    latencies = []
+
+    def client(chunk):
+        for input_dict in chunk:
+            start = time.perf_counter()
+            website.predict_from_user(serving, input_dict)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(n_clients) as pool:
+        list(pool.map(client, [inputs[i::n_clients] for i in range(n_clients)]))
+    seconds = time.perf_counter() - start
+
+    return {
+        "requests": len(inputs),
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(len(inputs) / seconds, 1),
+        "p50_ms": round(np.percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(np.percentile(latencies, 95) * 1000, 2),
+    }
+
+
+def load_test(n_requests: int = 2000, client_counts: tuple = (1, 8, 32)) -> pd.DataFrame:
+    """
+    Input:
+        n_requests: requests sent for every run
+        client_counts: numbers of concurrent clients to test
+
+    Compares predicting every request on its own with micro batching (see micro_batcher.py)
+    for different numbers of concurrent clients. The cache and response surface are skipped,
+    every request is a different input.
+
+    Returns a dataframe with one row per mode and client count
+    """
+    website.models.start()
+    while not website.models.ready:
+        if website.models.error is not None:
+            raise RuntimeError(website.models.error)
+        time.sleep(0.1)
+
+    serving = dict(website.models.get(), surface=None)
+    inputs = random_inputs(n_requests)
+
+    results = []
+    for n_clients in client_counts:
+        for micro_batching in [False, True]:
+            website.USE_MICRO_BATCHING = micro_batching
+            result = run_clients(serving, inputs, n_clients)
+            results.append(
+                {
+                    "mode": "micro batched" if micro_batching else "per request",
+                    "clients": n_clients,
+                    **result,
+                }
+            )
+            print(f"BENCHMARK : {results[-1]}")
+
+    report = pd.DataFrame(results)
+    print(report.to_string(index=False))
+    print(f"BENCHMARK : Micro batcher {website.micro_batcher.stats()}")
+
+    return report
+
+
+if __name__ == "__main__":
+    """
+    Example: python app/load_test.py --requests 2000 --clients 1 8 32
+    """
+    parser = argparse.ArgumentParser(
+        description="Load test per request prediction against micro batching"
+    )
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32])
+    args = parser.parse_args()
+
+    load_test(args.requests, args.clients)
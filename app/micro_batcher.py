@@ -0,0 +1,113 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# most requests predicted together
+MAX_BATCH_SIZE = 32
+# seconds the first request in a batch waits for others to join it
+MAX_WAIT = 0.005
+
+
+class MicroBatcher:
+    """
+    Collects items submitted from many threads (concurrent web requests) for up to max_wait seconds,
+    and processes them together with one call to process(group, items), which returns one result per item.
+
+    Only items submitted with the same group are processed together, the app uses what it predicts
+    with as the group, so a batch never mixes two models (ex. while a new model is swapped in).
+    """
+
+    def __init__(
+        self, process, max_batch_size: int = MAX_BATCH_SIZE, max_wait: float = MAX_WAIT
+    ):
+        """
+        process: function (group, list of items) -> list of results, in the same order
+        max_batch_size: most items in one call to process
+        max_wait: seconds to wait for more items after the first one arrives
+        """
+        self._process = process
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.batches = 0
+        self.items = 0
+
+    def submit(self, item, group=None) -> Future:
+        """
+        Queues item, returns a future with its result
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="micro-batcher", daemon=True
+                )
+                self._thread.start()
+
+        future = Future()
+        self._queue.put((group, item, future))
+        return future
+
+    def predict(self, item, group=None):
+        """
+        Queues item and waits for its result, exceptions from process are raised here
+        """
+        return self.submit(item, group).result()
+
+    def _collect(self) -> list:
+        """
+        Waits for the first item, then takes more until the batch is full or max_wait has passed
+        """
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    # take what is already waiting, without waiting for more
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+
+            # split by group, keeping the order items arrived in
+            groups = {}
+            for group, item, future in batch:
+                groups.setdefault(id(group), (group, []))[1].append((item, future))
+
+            for group, entries in groups.values():
+                items = [item for item, _ in entries]
+                try:
+                    results = list(self._process(group, items))
+                    if len(results) != len(items):
+                        raise RuntimeError(
+                            f"process returned {len(results)} results for {len(items)} items"
+                        )
+                except Exception as e:
+                    # every waiting request gets the error, none is left waiting forever
+                    for _, future in entries:
+                        future.set_exception(e)
+                    continue
+
+                for (_, future), result in zip(entries, results):
+                    future.set_result(result)
+
+                self.batches += 1
+                self.items += len(items)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": round(self.items / self.batches, 2) if self.batches else None,
+        }
@@ -0,0 +1,114 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from appmodels import INPUT_COLUMNS
+
+# how many predictions are kept, the least recently used are dropped first
+CACHE_SIZE = 4096
+# weather inputs are rounded to this many decimals, the weather data has one decimal
+CACHE_DECIMALS = 1
+
+
+def canonical_inputs(input_dict: dict, decimals: int = CACHE_DECIMALS) -> tuple:
+    """
+    Input:
+        input_dict: the inputs from the website (DateFormatted and the INPUT_COLUMNS, as strings)
+        decimals: decimals the weather values are rounded to
+
+    Minutes and seconds are not features (the hour, weekday, month and holiday are), so the date is
+    cut to the hour, and numbers are rounded so "5", "5.0" and "5.04" are the same key.
+    Missing or "" values are None.
+
+    Inputs that differ by less than the rounding share a key, so close to a split in the trees
+    (ex. Lufttrykk 996.04 and 995.96) a cached answer can be the prediction for the other one.
+    Set decimals higher if that matters more than the hit rate.
+
+    Returns a hashable key, or None if the inputs can not be read (those are not cached)
+    """
+    try:
+        date = datetime.strptime(input_dict.get("DateFormatted", ""), "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return None
+
+    values = []
+    for col in INPUT_COLUMNS:
+        value = input_dict.get(col)
+        if value is None or value == "":
+            values.append(None)
+            continue
+        try:
+            value = round(float(value), decimals)
+        except (TypeError, ValueError):
+            return None
+        # nan != nan, so it would never be found again
+        if value != value:
+            return None
+        values.append(value + 0.0)  # -0.0 and 0.0 are the same key
+
+    return (date.strftime("%Y-%m-%d %H:00:00"), *values)
+
+
+class PredictionCache:
+    """
+    Bounded LRU cache of website predictions, keyed on canonical_inputs.
+
+    Every entry belongs to a model version, when the app starts predicting with another version
+    (a new artifact) the whole cache is cleared, so an old prediction is never returned.
+    """
+
+    def __init__(self, max_size: int = CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check_version(self, version) -> None:
+        if version != self.version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.version = version
+
+    def get(self, key: tuple, version):
+        """
+        Returns the cached value for key, or None if it is not cached for this model version
+        """
+        with self._lock:
+            self._check_version(version)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: tuple, version, value) -> None:
+        with self._lock:
+            self._check_version(version)
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        """
+        Returns the hit rate and counters of the cache
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "model_version": self.version,
+            }
@@ -0,0 +1,370 @@
+import itertools
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from appmodels import FEATURE_COLUMNS, PUBLIC_HOLIDAYS
+from joblib import Parallel, cpu_count, delayed
+
+# get current filepath to use when opening/saving files
+PWD = Path().absolute()
+
+RESPONSE_SURFACE_DIR = f"{PWD}/app/response_surface"
+
+# the weather values the model is evaluated at, anything in between is interpolated.
+# Lufttrykk has knots on both sides of 996, where "raining" switches on (see feauture_engineer).
+# Vindstyrke is not a knot, the model does not use it
+RESPONSE_GRID = {
+    "Globalstraling": [0, 150, 500, 900],
+    "Solskinstid": [0, 10],
+    "Lufttemperatur": [-10, 5, 20, 35],
+    "Lufttrykk": [970, 996, 997, 1030],
+    "Vindkast": [0, 10, 30],
+    "Vindretning": [0, 120, 240, 360],
+}
+
+# every calendar cell is looked up exactly: hour, weekday, month, public holiday
+CALENDAR_SHAPE = (24, 7, 12, 2)
+
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+def calendar_features(hour: int, weekday: int, month: int, holiday: int) -> dict:
+    """
+    Returns the date coloumns feauture_engineer makes, for one calendar cell
+    """
+    features = {f"d_{day}": int(weekday == i) for i, day in enumerate(DAYS)}
+    features.update(
+        {
+            "hour": hour,
+            "month": month,
+            "weekend": int(weekday >= 5),
+            "public_holiday": holiday,
+            "summer": int(5 < month < 8),
+            "winter": int(month >= 10 or month <= 2),
+            "rush_hour": int(7 <= hour <= 9 or 15 <= hour <= 17),
+            "sleeptime": int(hour >= 22 or hour < 6),
+        }
+    )
+    return features
+
+
+def weather_features(weather: np.ndarray, names: list) -> dict:
+    """
+    Returns the weather coloumns feauture_engineer makes, for rows of weather values in names order
+    """
+    columns = dict(zip(names, weather.T))
+    radians = np.radians(columns.pop("Vindretning"))
+
+    columns["raining"] = (columns["Lufttrykk"] <= 996).astype(int)
+    columns["Vindretning_x"] = np.cos(radians)
+    columns["Vindretning_y"] = np.sin(radians)
+
+    return columns
+
+
+def predict_cells(model, cells: list, weather_points: np.ndarray, names: list) -> np.ndarray:
+    """
+    Predicts every weather point for each of the given calendar cells
+
+    Returns an array of shape (cells, weather points)
+    """
+
+    weather = weather_features(weather_points, names)
+    values = np.empty((len(cells), len(weather_points)), dtype=np.float32)
+
+    for i, (hour, weekday, month_index, holiday) in enumerate(cells):
+        rows = pd.DataFrame(
+            {**calendar_features(hour, weekday, month_index + 1, holiday), **weather}
+        )
+        values[i] = model.predict(rows[FEATURE_COLUMNS])
+
+    return values
+
+
+class ResponseSurface:
+    """
+    Model predictions precomputed over a grid, see build_response_surface.
+
+    The calendar part of the grid is exact, the weather part is either looked up at the nearest knot
+    or interpolated multilinearly between the knots around the input.
+
+    model_sha256 is the sha256 of the model artifact the surface was built from (see artifacts.py),
+    so the app only answers from it while that model is served
+    """
+
+    def __init__(
+        self, values: np.ndarray, grid: dict, error: dict = None, model_sha256: str = None
+    ):
+        self.values = values
+        self.grid = grid
+        self.names = list(grid.keys())
+        self.knots = [np.asarray(knots, dtype=np.float64) for knots in grid.values()]
+        self.error = error
+        self.model_sha256 = model_sha256
+
+    def predict(
+        self, calendar: np.ndarray, weather: np.ndarray, method: str = "linear"
+    ) -> np.ndarray:
+        """
+        Input:
+            calendar: int array of shape (rows, 4) with hour, weekday (0=Monday), month (1-12), public holiday
+            weather: array of shape (rows, len(grid)), in grid order, within the grid
+            method: "linear" to interpolate, "nearest" to use the closest knot
+
+        Returns the surface value for every row
+        """
+
+        calendar = np.asarray(calendar, dtype=np.intp).copy()
+        calendar[:, 2] -= 1  # months are stored from 0
+        weather = np.asarray(weather, dtype=np.float64)
+        n_rows, n_dims = weather.shape
+
+        # position of the knot below each value, and how far it is to the next knot (0-1)
+        lower = np.empty((n_rows, n_dims), dtype=np.intp)
+        fraction = np.empty((n_rows, n_dims))
+        for d, knots in enumerate(self.knots):
+            lower[:, d] = np.clip(
+                np.searchsorted(knots, weather[:, d], side="right") - 1, 0, len(knots) - 2
+            )
+            fraction[:, d] = (weather[:, d] - knots[lower[:, d]]) / (
+                knots[lower[:, d] + 1] - knots[lower[:, d]]
+            )
+
+        if method == "nearest":
+            nearest = lower + (fraction >= 0.5)
+            return self.values[(*calendar.T, *nearest.T)].astype(np.float64)
+
+        # gather the 2 x 2 x ... block of knots around every row in one go
+        corner = (slice(None),) + (None,) * n_dims
+        index = [calendar[:, i][corner] for i in range(calendar.shape[1])]
+        for d in range(n_dims):
+            shape = [1] * n_dims
+            shape[d] = 2
+            index.append(lower[:, d][corner] + np.arange(2).reshape(shape))
+        block = self.values[tuple(index)].astype(np.float64)
+
+        # then shrink it one weather dimension at a time
+        for d in range(n_dims):
+            weight = fraction[:, d].reshape((n_rows,) + (1,) * (n_dims - d - 1))
+            block = block[:, 0] * (1 - weight) + block[:, 1] * weight
+
+        return block
+
+    def inputs_from_user(self, input_dict: dict) -> (np.ndarray, np.ndarray):
+        """
+        Turns the inputs from the website into calendar and weather arrays for predict
+
+        Returns None if the date or a weather value is missing, malformed or outside the grid,
+        then the model should answer instead
+        """
+
+        try:
+            date = datetime.strptime(input_dict["DateFormatted"], "%Y-%m-%d %H:%M:%S")
+            weather = [float(input_dict[name]) for name in self.names]
+        except (KeyError, TypeError, ValueError):
+            return None
+
+        for value, knots in zip(weather, self.knots):
+            if not knots[0] <= value <= knots[-1]:
+                return None
+
+        calendar = [
+            date.hour,
+            date.weekday(),
+            date.month,
+            int(date.strftime("%m-%d") in PUBLIC_HOLIDAYS),
+        ]
+
+        return np.array([calendar]), np.array([weather])
+
+    def predict_from_user(self, input_dict: dict, method: str = "linear") -> float:
+        """
+        Returns the surface value for the inputs from the website, or None (see inputs_from_user)
+        """
+        inputs = self.inputs_from_user(input_dict)
+        if inputs is None:
+            return None
+        return float(self.predict(*inputs, method=method)[0])
+
+
+def build_response_surface(
+    model, grid: dict = None, n_workers: int = None
+) -> ResponseSurface:
+    """
+    Input:
+        model: anything with a predict taking FEATURE_COLUMNS, ex. load_best_model()
+        grid: weather knots, see RESPONSE_GRID, which is used if None
+        n_workers: number of processes to use, defaults to one per cpu
+
+    Predicts every combination of calendar cell and weather knots. The calendar cells are
+    split evenly between the workers, so the model is only sent once to each of them.
+
+    Returns the ResponseSurface
+    """
+
+    if grid is None:
+        grid = RESPONSE_GRID
+    if n_workers is None:
+        n_workers = cpu_count()
+
+    names = list(grid.keys())
+    weather_points = np.array(list(itertools.product(*grid.values())), dtype=np.float64)
+    cells = list(itertools.product(*[range(size) for size in CALENDAR_SHAPE]))
+
+    print(
+        f"SURFACE : Predicting {len(cells)} calendar cells x {len(weather_points)} weather points on {n_workers} workers"
+    )
+
+    start_time = time.perf_counter()
+    parts = Parallel(n_jobs=n_workers)(
+        delayed(predict_cells)(model, [cells[i] for i in chunk], weather_points, names)
+        for chunk in np.array_split(np.arange(len(cells)), n_workers)
+        if len(chunk)
+    )
+    print(f"SURFACE : Built in {round(time.perf_counter() - start_time, 2)} seconds")
+
+    values = np.concatenate(parts).reshape(
+        CALENDAR_SHAPE + tuple(len(knots) for knots in grid.values())
+    )
+    return ResponseSurface(values, grid)
+
+
+def surface_inputs(X: pd.DataFrame, names: list) -> (np.ndarray, np.ndarray):
+    """
+    Recovers calendar and weather arrays for ResponseSurface.predict from processed data (FEATURE_COLUMNS)
+    """
+    weekday = X[[f"d_{day}" for day in DAYS]].to_numpy().argmax(axis=1)
+    calendar = np.column_stack(
+        [X["hour"], weekday, X["month"], X["public_holiday"]]
+    ).astype(np.intp)
+
+    direction = np.degrees(np.arctan2(X["Vindretning_y"], X["Vindretning_x"])) % 360
+    weather = np.column_stack(
+        [direction if name == "Vindretning" else X[name] for name in names]
+    ).astype(np.float64)
+
+    return calendar, weather
+
+
+def surface_error(surface: ResponseSurface, model, X_val: pd.DataFrame, y_val) -> dict:
+    """
+    Input:
+        surface: the response surface
+        model: the model it was built from
+        X_val/y_val: processed validation data
+
+    Compares the surface with the model on the validation rows that are inside the grid.
+    The percentiles of the absolute difference are the error bound of the surface, they are measured
+    and not guaranteed, inputs far from any validation row can be off by more.
+
+    Returns a dict with the coverage, the absolute difference percentiles and both RMSEs
+    """
+
+    calendar, weather = surface_inputs(X_val, surface.names)
+    inside = np.all(
+        [
+            (weather[:, d] >= knots[0]) & (weather[:, d] <= knots[-1])
+            for d, knots in enumerate(surface.knots)
+        ],
+        axis=0,
+    )
+
+    y_model = model.predict(X_val[inside])
+    y_true = np.asarray(y_val, dtype=np.float64)[inside]
+
+    error = {"coverage": round(float(inside.mean()), 4)}
+
+    for method in ["linear", "nearest"]:
+        y_surface = surface.predict(calendar[inside], weather[inside], method)
+        difference = np.abs(y_surface - y_model)
+
+        for q in [50, 95, 99]:
+            error[f"{method}_abs_diff_p{q}"] = round(float(np.percentile(difference, q)), 3)
+        error[f"{method}_abs_diff_max"] = round(float(difference.max()), 3)
+        error[f"{method}_rmse"] = round(float(np.sqrt(np.mean((y_surface - y_true) ** 2))), 3)
+
+    error["model_rmse"] = round(float(np.sqrt(np.mean((y_model - y_true) ** 2))), 3)
+
+    for key, value in error.items():
+        print(f"SURFACE : {key} = {value}")
+
+    return error
+
+
+def save_response_surface(
+    surface: ResponseSurface, directory: str = RESPONSE_SURFACE_DIR
+) -> None:
+    """
+    Saves the surface values as .npy and the grid, error bound and model sha256 as meta.json.
+    The files are written to a temp folder first, so a half written surface is never loaded.
+    """
+
+    tmp_directory = f"{directory}.tmp"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+
+    np.save(f"{tmp_directory}/values.npy", np.ascontiguousarray(surface.values))
+    with open(f"{tmp_directory}/meta.json", "w") as f:
+        json.dump(
+            {
+                "grid": surface.grid,
+                "error": surface.error,
+                "model_sha256": surface.model_sha256,
+            },
+            f,
+            indent=4,
+        )
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+
+
+def load_response_surface(directory: str = RESPONSE_SURFACE_DIR) -> ResponseSurface:
+    """
+    Loads a surface saved with save_response_surface, the values are memory mapped.
+    Surfaces saved before the model sha256 was stored get None, which matches no model
+    """
+    with open(f"{directory}/meta.json") as f:
+        meta = json.load(f)
+    values = np.load(f"{directory}/values.npy", mmap_mode="r")
+    return ResponseSurface(
+        values, meta["grid"], meta["error"], meta.get("model_sha256")
+    )
+
+
+if __name__ == "__main__":
+    """
+    Builds the response surface for the best model, measures its error and saves it for the app
+    """
+    from appmodels import load_best_model, load_validation_data, model_artifact_name
+    from artifacts import ArtifactManager
+
+    best_model = load_best_model()
+    # load_best_model saves the model if it had to train it, so the manifest is there now
+    manifest = ArtifactManager().manifest(model_artifact_name())
+    X_val, y_val = load_validation_data()
+
+    surface = build_response_surface(best_model)
+    surface.model_sha256 = manifest["sha256"]
+    surface.error = surface_error(surface, best_model, X_val, y_val)
+    save_response_surface(surface)
+    print(f"SURFACE : Saved response surface to {RESPONSE_SURFACE_DIR}")
+
+    # time a single lookup, like the website does
+    example = {"DateFormatted": "2023-01-01 08:00:00"}
+    example.update({name: str(knots[1]) for name, knots in RESPONSE_GRID.items()})
+    surface = load_response_surface()
+
+    lookup_us = []
+    for _ in range(1000):
+        start_time = time.perf_counter()
+        surface.predict_from_user(example)
+        lookup_us.append((time.perf_counter() - start_time) * 1e6)
+    print(f"SURFACE : single lookup p50 = {round(np.percentile(lookup_us, 50), 1)} us")
+    print(f"SURFACE : single lookup p99 = {round(np.percentile(lookup_us, 99), 1)} us")
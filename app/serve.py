@@ -0,0 +1,175 @@
+import argparse
+import gc
+import os
+import signal
+import socket
+import time
+
+import app as website
+from forest_engine import FlatForest
+from werkzeug.serving import make_server
+
+# one hour of inputs, predicted once before forking so everything the prediction path loads
+# lazily (the imputer, pandas internals) is loaded in the master and shared with the workers
+WARM_UP_INPUT = {
+    "DateFormatted": "2023-06-01 08:00:00",
+    "Globalstraling": "300",
+    "Solskinstid": "5",
+    "Lufttemperatur": "15",
+    "Vindretning": "200",
+    "Vindstyrke": "3",
+    "Lufttrykk": "1010",
+    "Vindkast": "6",
+}
+
+
+def process_memory(pid: int) -> dict:
+    """
+    Returns the proportional (Pss, shared pages split between the processes sharing them) and
+    private dirty memory of a process in MB, or None where /proc/<pid>/smaps_rollup does not exist (not linux)
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+
+    memory = {}
+    for line in lines:
+        field, _, value = line.partition(":")
+        if field in ("Rss", "Pss", "Private_Dirty"):
+            memory[field] = round(int(value.split()[0]) / 1024, 1)
+    return memory
+
+
+def load_once() -> dict:
+    """
+    Loads the model and the serving imputer in this (the master) process, before any worker is forked
+
+    Returns what the app predicts with
+    """
+    website.models.start()
+    if not website.models.wait():
+        raise RuntimeError(f"The model could not be loaded: {website.models.error}")
+
+    serving = website.models.get()
+    if not isinstance(serving["predictor"], FlatForest):
+        print(
+            "INFO : The predictor is not a FlatForest, its many small objects "
+            "will be copied into every worker over time"
+        )
+
+    website.predict_user_batch(serving, [WARM_UP_INPUT])
+
+    # move everything loaded so far out of the garbage collector's generations, a collection in a worker
+    # would otherwise write to the header of every object and copy the pages holding them
+    gc.collect()
+    gc.freeze()
+
+    return serving
+
+
+def run_worker(listener: socket.socket) -> None:
+    """
+    Serves requests from the shared listening socket until the process is stopped, never returns
+    """
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, website.reload_on_signal)
+
+    server = make_server(
+        listener.getsockname()[0],
+        listener.getsockname()[1],
+        website.app,
+        threaded=True,
+        fd=listener.fileno(),
+    )
+    try:
+        server.serve_forever()
+    finally:
+        os._exit(0)
+
+
+def serve(host: str = "0.0.0.0", port: int = 8080, n_workers: int = None) -> None:
+    """
+    Input:
+        host/port: address to listen on
+        n_workers: number of worker processes, defaults to one per cpu
+
+    Production entry point (instead of app.run, whose reloader imports the app twice).
+    The model is loaded once, then n_workers processes are forked which share its memory copy on write
+    and accept connections from the same listening socket. Workers that die are replaced.
+    kill -HUP <master pid> hot reloads the model in every worker (see app.reload_on_signal).
+    Only works where os.fork exists (linux, mac).
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    load_once()
+
+    listener = socket.create_server((host, port), backlog=1024)
+    listener.set_inheritable(True)
+    print(f"INFO : Listening on http://{host}:{port} with {n_workers} workers")
+
+    workers = set()
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reload(signum, frame):
+        # every worker loads and checks the new model itself, and keeps serving the old one until then
+        for pid in workers:
+            os.kill(pid, signal.SIGHUP)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGHUP, reload)
+
+    def fork_worker():
+        pid = os.fork()
+        if pid == 0:
+            run_worker(listener)
+        workers.add(pid)
+
+    for _ in range(n_workers):
+        fork_worker()
+
+    time.sleep(1)
+    for pid in [os.getpid(), *workers]:
+        print(f"INFO : Memory of {pid} (MB): {process_memory(pid)}")
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+
+        workers.discard(pid)
+        if not stopping:
+            print(f"INFO : Worker {pid} stopped ({status}), starting a new one")
+            fork_worker()
+
+    listener.close()
+    print("INFO : All workers stopped")
+
+
+if __name__ == "__main__":
+    """
+    Example: python app/serve.py --workers 4 --port 8080
+    """
+    parser = argparse.ArgumentParser(
+        description="Serve the website from several processes"
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.workers)
@@ -0,0 +1,176 @@
+import threading
+import time
+import traceback
+
+
+class ModelHolder:
+    """
+    Holds what the app predicts with, and loads it in a background thread, so the server can
+    answer (health checks, "warming up" pages) while the model is loaded or built from scratch.
+
+    A new model can be reloaded while serving: it is loaded and validated in the background and
+    only then swapped in, requests keep the value they got from get, so they finish on the old model.
+    """
+
+    def __init__(self, load, reload=None, validate=None):
+        """
+        load: function without arguments that returns what the app predicts with
+        reload: function without arguments used to load a new model while serving, defaults to load
+        validate: function that raises if what reload returned can not be served
+        """
+        self._load = load
+        self._reload = reload if reload is not None else load
+        self._validate = validate
+        self._lock = threading.Lock()
+        self._thread = None
+        self._reload_thread = None
+        self._value = None
+        self.error = None
+        self.started = None
+        self.ready_seconds = None
+        self.last_reload = None
+        self._stamp = None
+        self._stamp_seen = None
+        self._stamp_interval = None
+        self._last_check = 0.0
+
+    def start(self) -> None:
+        """
+        Starts loading in a background thread, if it has not been started already
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.started = time.time()
+            self._thread = threading.Thread(
+                target=self._warm_up, name="model-warm-up", daemon=True
+            )
+            self._thread.start()
+
+    def _warm_up(self) -> None:
+        print("INFO : Warming up the model in the background")
+        try:
+            value = self._load()
+        except Exception as e:
+            traceback.print_exc()
+            self.error = repr(e)
+            return
+
+        self.set(value)
+        self.ready_seconds = round(time.time() - self.started, 2)
+        print(f"INFO : Model ready after {self.ready_seconds} seconds")
+
+    def set(self, value) -> None:
+        """
+        Replaces what the app predicts with, requests already running keep the value they got
+        """
+        with self._lock:
+            self._value = value
+            self.error = None
+
+    def reload(self) -> bool:
+        """
+        Starts loading a new model in a background thread, unless a load or reload is already running
+
+        Returns True if a reload was started
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            if self._reload_thread is not None and self._reload_thread.is_alive():
+                return False
+            self._reload_thread = threading.Thread(
+                target=self._run_reload, name="model-reload", daemon=True
+            )
+            self._reload_thread.start()
+        return True
+
+    def _run_reload(self) -> None:
+        print("INFO : Reloading the model in the background")
+        started = time.time()
+        try:
+            value = self._reload()
+            if self._validate is not None:
+                self._validate(value)
+        except Exception as e:
+            traceback.print_exc()
+            self.last_reload = {"status": "failed", "error": repr(e)}
+            print("INFO : Reload failed, still serving the old model")
+            return
+
+        self.set(value)
+        self.last_reload = {
+            "status": "ok",
+            "seconds": round(time.time() - started, 2),
+            "finished": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        if self.ready_seconds is None:
+            self.ready_seconds = round(time.time() - self.started, 2)
+        print(f"INFO : Reloaded the model in {self.last_reload['seconds']} seconds")
+
+    def watch(self, stamp, interval: float = 5.0) -> None:
+        """
+        Input:
+            stamp: function without arguments that returns something that changes when there is a new model,
+                   ex. the mtime of the model's manifest
+            interval: least seconds between two calls to stamp
+
+        Reload when stamp changes, it is checked by poll (called on every request), so no extra thread
+        is needed and it keeps working in forked workers
+        """
+        self._stamp = stamp
+        self._stamp_interval = interval
+        self._stamp_seen = stamp()
+        self._last_check = time.monotonic()
+
+    def poll(self) -> None:
+        """
+        Checks the stamp given to watch, at most once every interval seconds, and reloads if it changed
+        """
+        if self._stamp is None:
+            return
+        if time.monotonic() - self._last_check < self._stamp_interval:
+            return
+        self._last_check = time.monotonic()
+
+        stamp = self._stamp()
+        if stamp != self._stamp_seen and self.reload():
+            self._stamp_seen = stamp
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Waits for the background thread to finish loading
+
+        Returns True if the model is ready
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.ready
+
+    def get(self):
+        """
+        Returns what the app predicts with, or None while it is warming up
+        """
+        return self._value
+
+    @property
+    def ready(self) -> bool:
+        return self._value is not None
+
+    def status(self) -> dict:
+        """
+        Returns the state of the holder, for the readiness endpoint
+        """
+        if self.ready:
+            status = {"status": "ready", "ready_seconds": self.ready_seconds}
+            if self.last_reload is not None:
+                status["last_reload"] = self.last_reload
+            return status
+        if self.error is not None:
+            return {"status": "failed", "error": self.error}
+        if self.started is None:
+            return {"status": "not started"}
+        return {
+            "status": "warming up",
+            "seconds": round(time.time() - self.started, 2),
+        }
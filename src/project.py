@@ -2,8 +2,8 @@ import os
 from pathlib import Path
 
 import pandas as pd
-from sklearn.ensemble import RandomForestRegressor
 
+from utils.benchmark import benchmark_models
 from utils.dataframe_handling import (
     drop_uneeded_cols,
     feauture_engineer,
@@ -13,6 +13,7 @@ from utils.dataframe_handling import (
     treat_2023_file,
     trim_transform_outliers,
 )
+from utils.distributed import scaling_report
 from utils.file_parsing import treat_florida_files, treat_trafikk_files
 from utils.graphing import (
     graph_a_vs_b,
@@ -22,9 +23,14 @@ from utils.graphing import (
     graph_monthly_amounts,
     graph_weekly_amounts,
 )
+from utils.hyperparam_search import successive_halving_search
+from utils.matrices import add_matrices
 from utils.models import (
+    BEST_MODEL,
+    HIST_GBM_MODEL,
     find_hyper_param,
     find_hyper_param_further,
+    get_best_model,
     train_best_model,
     train_models,
 )
@@ -35,10 +41,25 @@ DEBUG = False
 GRAPHING = True
 TRAIN_MANY = True
 FINAL_RUN = True
+PARALLEL_MODELS = True
+HALVING_SEARCH = False  # successive halving search over SEARCH_SPACE, trains many configurations
+CV_BY = None  # "year" or "season" to use walk-forward cross validation
+MODEL_CACHE = False  # save fitted models in src/out/model_cache to skip refitting next run
+BENCHMARK = False  # compare the forest with histogram boosting
+PERMUTATION_IMPORTANCE = False  # shuffle each feature on validation data to see how much it matters
+SCALING_REPORT = False  # time the best forest sharded over 1, 2, 4 .. workers
+USE_HIST_GBM = False  # use histogram boosting instead of the forest as the best model
+# histogram boosting handles NaN so the KNN imputer is skipped for it, every other model needs imputed data
+IMPUTE = not USE_HIST_GBM
 RANDOM_STATE = 2
 
 
 def main():
+    if not IMPUTE and TRAIN_MANY:
+        raise ValueError(
+            "train_models needs imputed data, set TRAIN_MANY = False with USE_HIST_GBM"
+        )
+
     print("INFO : Starting parsing ... ")
     # loop over files in local directory
     directory = f"{str(PWD)}/src/raw_data"
@@ -105,7 +126,7 @@ def main():
         print("INFO : This could take a while...")
 
         # transform NaN and outliers to usable data
-        df_transforming = trim_transform_outliers(df_transforming, False)
+        df_transforming = trim_transform_outliers(df_transforming, False, IMPUTE)
         print(f"INFO : Outliers trimmed for {name}")
 
         # add features to help the model
@@ -185,33 +206,57 @@ def main():
         "x_test": test_df.drop(["Total_trafikk"], axis=1),
     }
 
+    # convert the data to the arrays sklearn uses once, instead of in every fit/predict
+    split_dict_post = add_matrices(split_dict_post)
+
     # train models
     if TRAIN_MANY:
-        train_models(split_dict_post)
+        train_models(split_dict_post, parallel=PARALLEL_MODELS, cv_by=CV_BY)
         # find hyper params for the best model
         find_hyper_param(split_dict_post)
         find_hyper_param_further(split_dict_post)
 
+    if HALVING_SEARCH:
+        # search more than n_estimators, cheap configurations are tried on less data first
+        successive_halving_search(split_dict_post)
+
+    cache_dir = f"{PWD}/src/out/model_cache" if MODEL_CACHE else None
+
+    if BENCHMARK:
+        benchmark_models(
+            split_dict_post, [BEST_MODEL, HIST_GBM_MODEL], cache_dir=cache_dir
+        )
+
+    if SCALING_REPORT:
+        scaling_report(split_dict_post, BEST_MODEL["settings"])
+    best = HIST_GBM_MODEL if USE_HIST_GBM else BEST_MODEL
+
     # train the best model on validation data
+    # the best model is only fitted once, and reused from the model registry after that
     print("INFO: Training model on validation data")
-    train_best_model(split_dict_post, test_data=False)
+    train_best_model(
+        split_dict_post,
+        test_data=False,
+        cv_by=CV_BY,
+        cache_dir=cache_dir,
+        model=best,
+        importance_report=PERMUTATION_IMPORTANCE,
+    )
 
     if FINAL_RUN:
         # train best model on test data
         print("INFO: Training model on test data")
-        train_best_model(split_dict_post, test_data=True)
+        train_best_model(split_dict_post, test_data=True, cache_dir=cache_dir, model=best)
 
         print("INFO : Treating 2023 files")
 
-        # use the best model to get values for 2023
-        best_model = RandomForestRegressor(n_estimators=181, random_state=RANDOM_STATE)
-
-        X_train = split_dict_post["x_train"]
-        y_train = split_dict_post["y_train"]
-
         # the best model is used to treat 2023 files.
-        best_model.fit(X_train, y_train)
-        df_with_values = treat_2023_file(df_2023, best_model)
+        df_with_values = treat_2023_file(
+            df_2023,
+            get_best_model(split_dict_post, cache_dir, best),
+            split_dict_post,
+            impute=IMPUTE,
+        )
 
     return split_dict_post, training_df, test_df, validation_df
 
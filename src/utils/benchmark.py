@@ -0,0 +1,73 @@
+import pickle
+import time
+from math import sqrt
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import mean_squared_error
+
+from utils.matrices import fit_data
+from utils.model_registry import get_or_fit
+
+
+def benchmark_models(
+    split_dict: dict, models: list, n_single_rows: int = 200, cache_dir: str = None
+) -> pd.DataFrame:
+    """
+    Input:
+        split_dict : split_dict containing x/y train/val/test
+        models: list of model dicts (see train_models) to compare
+        n_single_rows: how many single row predictions to time, like the website does
+        cache_dir: see get_or_fit
+
+    Models are fitted through the model registry, so a model benchmarked here is not fitted again
+    by train_best_model. fit_seconds is ~0 for a model that was already fitted.
+
+    Compares fit time, predict latency for a single row and for the whole validation set,
+    the size of the pickled model and the RMSE on validation data.
+
+    Returns a dataframe with one row per model
+    """
+
+    rows = []
+
+    for mod in models:
+        name = f"{str(mod['model_type'].__name__)[0:8]}_{mod['settings']}"
+        print(f"BENCHMARK : Benchmarking {name}")
+
+        X_train, y_train, X_val, y_val = fit_data(split_dict, mod["model_type"])
+
+        start_time = time.perf_counter()
+        clf = get_or_fit(mod["model_type"], mod["settings"], X_train, y_train, cache_dir)
+        fit_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        y_predicted = clf.predict(X_val)
+        batch_seconds = time.perf_counter() - start_time
+
+        # time one row at a time, as the website predicts
+        single_row_ms = []
+        for i in range(min(n_single_rows, len(X_val))):
+            row = X_val[i : i + 1]
+            start_time = time.perf_counter()
+            clf.predict(row)
+            single_row_ms.append((time.perf_counter() - start_time) * 1000)
+
+        rows.append(
+            {
+                "model_name": name,
+                "fit_seconds": round(fit_seconds, 3),
+                "batch_predict_seconds": round(batch_seconds, 4),
+                "single_row_p50_ms": round(np.percentile(single_row_ms, 50), 3),
+                "single_row_p99_ms": round(np.percentile(single_row_ms, 99), 3),
+                "model_size_mb": round(len(pickle.dumps(clf)) / 1e6, 2),
+                "rmse": sqrt(mean_squared_error(y_val, y_predicted)),
+            }
+        )
+
+    results = pd.DataFrame(rows)
+
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(results)
+
+    return results
@@ -0,0 +1,207 @@
+import shutil
+import time
+from math import sqrt
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.metrics import mean_squared_error
+from threadpoolctl import threadpool_limits
+
+from utils.matrices import model_dtype, to_matrix
+from utils.parallel import available_cpus, share_matrices, threads_per_worker
+
+SEASONS = {
+    12: "winter",
+    1: "winter",
+    2: "winter",
+    3: "spring",
+    4: "spring",
+    5: "spring",
+    6: "summer",
+    7: "summer",
+    8: "summer",
+    9: "autumn",
+    10: "autumn",
+    11: "autumn",
+}
+
+
+def period_labels(index: pd.DatetimeIndex, by: str) -> pd.Series:
+    """
+    Input:
+        index: the date index of the data
+        by: "year" or "season"
+
+    Returns a label for each row saying which year or season (ex "2016-winter") it belongs to.
+    December belongs to the winter of the following year.
+    """
+
+    if by == "year":
+        return pd.Series(index.year.astype(str), index=index)
+
+    if by == "season":
+        season_year = index.year + (index.month == 12)
+        seasons = index.month.map(SEASONS)
+        return pd.Series(
+            [f"{year}-{season}" for year, season in zip(season_year, seasons)],
+            index=index,
+        )
+
+    raise ValueError(f"Unknown fold period '{by}', use 'year' or 'season'")
+
+
+def walk_forward_folds(
+    index: pd.DatetimeIndex, by: str = "year", min_train_periods: int = 2
+) -> list:
+    """
+    Input:
+        index: sorted date index of the data
+        by: "year" or "season", each fold validates on one of these
+        min_train_periods: how many periods the first fold trains on
+
+    Each fold trains on every period before the one it validates on, so the model never sees the future.
+    The data is sorted, so every fold is a pair of slices.
+
+    Returns a list of dicts with the fold name, train_end, val_start and val_end row positions
+    """
+
+    if not index.is_monotonic_increasing:
+        raise ValueError("Walk-forward folds need data sorted by date")
+
+    labels = period_labels(index, by).to_numpy()
+
+    # position where each period starts, periods are contiguous since the data is sorted
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    ends = np.r_[starts[1:], len(labels)]
+
+    folds = []
+    for period in range(min_train_periods, len(starts)):
+        folds.append(
+            {
+                "fold": labels[starts[period]],
+                "train_end": int(starts[period]),
+                "val_start": int(starts[period]),
+                "val_end": int(ends[period]),
+            }
+        )
+
+    return folds
+
+
+def score_fold(
+    model_type: type,
+    settings: dict,
+    X,
+    y,
+    fold: dict,
+    n_threads: int,
+) -> dict:
+    """
+    Trains a model on the training part of a fold, and finds its RMSE on the validation part.
+
+    X and y are sliced, not indexed, so a memory mapped X is not copied before sklearn sees it.
+
+    Returns a dict with the fold, RMSE and the time spent fitting and predicting
+    """
+
+    clf = model_type(**settings)
+    if "n_jobs" in clf.get_params():
+        clf.set_params(n_jobs=n_threads)
+
+    with threadpool_limits(limits=n_threads):
+        start_time = time.time()
+        clf.fit(X[: fold["train_end"]], y[: fold["train_end"]])
+        fit_seconds = time.time() - start_time
+
+        start_time = time.time()
+        y_predicted = clf.predict(X[fold["val_start"] : fold["val_end"]])
+        predict_seconds = time.time() - start_time
+
+    mse = mean_squared_error(y[fold["val_start"] : fold["val_end"]], y_predicted)
+
+    return {
+        "fold": fold["fold"],
+        "train_rows": fold["train_end"],
+        "val_rows": fold["val_end"] - fold["val_start"],
+        "rmse": sqrt(mse),
+        "fit_seconds": round(fit_seconds, 3),
+        "predict_seconds": round(predict_seconds, 3),
+    }
+
+
+def walk_forward_cv(
+    models: list,
+    X: pd.DataFrame,
+    y: pd.Series,
+    by: str = "year",
+    n_workers: int = None,
+) -> pd.DataFrame:
+    """
+    Input:
+        models: list of model dicts (see train_models)
+        X/y: data sorted by date, with the date as index
+        by: "year" or "season", see walk_forward_folds
+        n_workers: number of processes to use, defaults to one per cpu
+
+    Runs walk-forward cross validation for every model. All (model, fold) pairs are trained in a process pool,
+    sharing a single memory mapped copy of X for each dtype the models use (see utils.matrices).
+
+    Returns a dataframe with one row per model and fold, with RMSE and timings
+    """
+
+    folds = walk_forward_folds(X.index, by)
+    tasks = [(mod, fold) for mod in models for fold in folds]
+
+    if n_workers is None:
+        n_workers = min(len(tasks), available_cpus())
+    n_threads = threads_per_worker(n_workers)
+
+    print(
+        f"MODELS : Walk-forward CV by {by}: {len(models)} model(s) x {len(folds)} folds on {n_workers} workers"
+    )
+
+    dtypes = {np.dtype(model_dtype(mod["model_type"])).name for mod in models}
+    matrices = {f"x_{dtype}": to_matrix(X, dtype) for dtype in dtypes}
+    matrices["y"] = to_matrix(y, np.float64)
+
+    shared, folder = share_matrices(matrices)
+
+    try:
+        results = Parallel(n_jobs=n_workers)(
+            delayed(score_fold)(
+                mod["model_type"],
+                mod["settings"],
+                shared[f"x_{np.dtype(model_dtype(mod['model_type'])).name}"],
+                shared["y"],
+                fold,
+                n_threads,
+            )
+            for mod, fold in tasks
+        )
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    for (mod, _), result in zip(tasks, results):
+        result["model_name"] = f"{str(mod['model_type'].__name__)[0:8]}_{mod['settings']}"
+
+    columns = [
+        "model_name",
+        "fold",
+        "train_rows",
+        "val_rows",
+        "rmse",
+        "fit_seconds",
+        "predict_seconds",
+    ]
+    return pd.DataFrame(results)[columns]
+
+
+def cv_data(split_dict: dict) -> (pd.DataFrame, pd.Series):
+    """
+    Joins training and validation data to one chronological frame to do walk-forward cross validation on.
+    Test data is left out so it can still be used for the final check.
+    """
+    X = pd.concat([split_dict["x_train"], split_dict["x_val"]]).sort_index()
+    y = pd.concat([split_dict["y_train"], split_dict["y_val"]]).loc[X.index]
+    return X, y
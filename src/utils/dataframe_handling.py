@@ -12,6 +12,9 @@ from sklearn.metrics import mean_squared_error
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import MinMaxScaler
 
+from utils.matrices import model_dtype, to_matrix
+from utils.models import forest_predict_intervals, get_best_model
+
 DEBUG = True
 PWD = Path().absolute()
 
@@ -180,11 +183,16 @@ def merge_frames(frames: list) -> (pd.DataFrame, pd.DataFrame):
     return df_2023, df_final
 
 
-def trim_transform_outliers(df: pd.DataFrame, data2023: bool) -> pd.DataFrame:
+def trim_transform_outliers(
+    df: pd.DataFrame, data2023: bool, impute: bool = True
+) -> pd.DataFrame:
     """
     Given a dataframe, trims values in the dataframe that are considered abnormal.
 
     What values are considered abnormal are covered in the README under "Dropped values"
+
+    If impute is False the abnormal values are left as NaN, for models that handle NaN
+    themselves (HistGradientBoostingRegressor)
     """
     # debug dict to look at lengths
     length_dict = {"before": len(df)}
@@ -251,13 +259,16 @@ def trim_transform_outliers(df: pd.DataFrame, data2023: bool) -> pd.DataFrame:
         columns=["Relativ luftfuktighet"], errors="ignore"
     )
 
-    # n_neighbors = 20 is best -> see report
-    imputer = KNNImputer(n_neighbors=20, weights="distance")
-    df_imputed = imputer.fit_transform(df_no_traffic)
+    if impute:
+        # n_neighbors = 20 is best -> see report
+        imputer = KNNImputer(n_neighbors=20, weights="distance")
+        df_imputed = imputer.fit_transform(df_no_traffic)
 
-    df_fixed = pd.DataFrame(
-        df_imputed, columns=df_no_traffic.columns, index=df_no_traffic.index
-    )
+        df_fixed = pd.DataFrame(
+            df_imputed, columns=df_no_traffic.columns, index=df_no_traffic.index
+        )
+    else:
+        df_fixed = df_no_traffic
 
     if not data2023:
         df_fixed = pd.concat([df_fixed, total_traffic_series], axis=1)
@@ -354,17 +365,31 @@ def train_test_split_process(
     return split_dict, training_df, test_df, validation_df
 
 
-def treat_2023_file(df: pd.DataFrame, model: RandomForestRegressor) -> pd.DataFrame:
+def treat_2023_file(
+    df: pd.DataFrame,
+    model: RandomForestRegressor = None,
+    split_dict: dict = None,
+    intervals: bool = True,
+    impute: bool = True,
+) -> pd.DataFrame:
     """
     A 2023 file handler, to fill in missing values given weather data
 
     Inputs:
         df: A dataframe contaning 2023 data
         model: the model to use to predict cycle trafikk
+        split_dict: if no model is given, the best model for this split_dict is taken from the model registry.
+                    Its feature_names (see utils.matrices) are used to order the coloumns for the model
+        intervals: if the model is a forest, also add the P10/P90 range across its trees
+                   (see forest_predict_intervals) to the predictions
+        impute: False for models trained without the KNN imputer, see trim_transform_outliers
     Returns:
         A dataframe much like the input, with the cycle traffic values filled in.
 
     """
+    if model is None:
+        model = get_best_model(split_dict)
+
     df = df.drop(
         columns=[
             "Trafikkmengde_Totalt_i_retning_Danmarksplass",
@@ -372,7 +397,7 @@ def treat_2023_file(df: pd.DataFrame, model: RandomForestRegressor) -> pd.DataFr
         ]
     )
 
-    df_fixed = trim_transform_outliers(df, True)
+    df_fixed = trim_transform_outliers(df, True, impute)
 
     # add important features to help the model
     df_final = feauture_engineer(df_fixed, True)
@@ -383,7 +408,17 @@ def treat_2023_file(df: pd.DataFrame, model: RandomForestRegressor) -> pd.DataFr
     print("PARSING : Uneeded cols dropped")
 
     try:
-        df_final["Total_trafikk"] = model.predict(df_final)
+        if split_dict is not None and "feature_names" in split_dict:
+            # the model was fitted on matrices, give it the coloumns in the same order
+            X = to_matrix(df_final[split_dict["feature_names"]], model_dtype(type(model)))
+        else:
+            X = df_final
+        if intervals and isinstance(model, RandomForestRegressor):
+            df_final["Total_trafikk"], ranges = forest_predict_intervals(model, X)
+            df_final["Prediksjon_P10"] = ranges[:, 0]
+            df_final["Prediksjon_P90"] = ranges[:, 1]
+        else:
+            df_final["Total_trafikk"] = model.predict(X)
     except ValueError as e:
         print(f"WARNING: MODEL PREDICTION ERROR {e}")
 
@@ -393,10 +428,15 @@ def treat_2023_file(df: pd.DataFrame, model: RandomForestRegressor) -> pd.DataFr
 
     df_final["Prediksjon"] = df_final["Total_trafikk"]
 
-    new_df = df_final[["Dato", "Tid", "Prediksjon"]].copy()
+    prediction_cols = [
+        col
+        for col in ["Prediksjon", "Prediksjon_P10", "Prediksjon_P90"]
+        if col in df_final.columns
+    ]
+    new_df = df_final[["Dato", "Tid"] + prediction_cols].copy()
 
     # make predictions to ints as float number of cyclists makes no sense.
-    new_df["Prediksjon"] = new_df["Prediksjon"].astype(int)
+    new_df[prediction_cols] = new_df[prediction_cols].astype(int)
 
     new_df.reset_index()
 
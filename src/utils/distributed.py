@@ -0,0 +1,160 @@
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.ensemble import RandomForestRegressor
+from threadpoolctl import threadpool_limits
+
+from utils.matrices import get_matrix
+from utils.parallel import available_cpus, share_matrices, threads_per_worker
+
+
+def fit_shard(
+    settings: dict, X, y, first_tree: int, n_trees: int, n_threads: int
+) -> RandomForestRegressor:
+    """
+    Input:
+        settings: forest settings, with a fixed random_state
+        X/y: the full training data (shared between workers)
+        first_tree/n_trees: the range of trees this shard fits
+        n_threads: threads this worker may use
+
+    Fits trees first_tree to first_tree + n_trees of the forest. With warm_start sklearn skips the seeds of
+    the trees that already exist, so the placeholders make it draw the same seeds (and bootstrap samples)
+    for these trees as a single fit of the whole forest would.
+
+    Returns a fitted forest holding only the trees of this shard
+    """
+
+    forest = RandomForestRegressor(**settings)
+    forest.set_params(
+        n_estimators=first_tree + n_trees, warm_start=True, n_jobs=n_threads
+    )
+
+    # placeholders for the trees fitted by the other shards
+    forest.estimators_ = [None] * first_tree
+
+    with threadpool_limits(limits=n_threads):
+        forest.fit(X, y)
+
+    forest.estimators_ = forest.estimators_[first_tree:]
+    return forest
+
+
+def merge_forests(shards: list) -> RandomForestRegressor:
+    """
+    Joins the trees of the shards, in order, into one forest
+    """
+    merged = shards[0]
+    merged.estimators_ = [tree for shard in shards for tree in shard.estimators_]
+    merged.set_params(n_estimators=len(merged.estimators_), warm_start=False, n_jobs=None)
+    return merged
+
+
+def sharded_forest_fit(
+    settings: dict,
+    X,
+    y,
+    n_workers: int = None,
+    backend: str = None,
+    folder: str = None,
+) -> RandomForestRegressor:
+    """
+    Input:
+        settings: forest settings, like BEST_MODEL["settings"]
+        X/y: training data
+        n_workers: number of workers, each fits an equal share of the trees. Defaults to one per cpu
+        backend: joblib backend, "loky" (local processes) if None. With a cluster backend like dask
+                 the workers can be on other machines
+        folder: where the shared matrices are written, must be reachable by every worker.
+                A local temp folder if None
+
+    Fits a forest by splitting its trees between workers that all read one memory mapped copy
+    of X and y. The merged forest has the same trees as RandomForestRegressor(**settings).fit(X, y).
+
+    Returns the merged forest
+    """
+
+    settings = dict(settings)
+    if settings.get("random_state") is None:
+        # every worker has to derive its seeds from the same state
+        settings["random_state"] = int(np.random.randint(np.iinfo(np.int32).max))
+
+    n_estimators = settings.get("n_estimators", RandomForestRegressor().n_estimators)
+    if n_workers is None:
+        n_workers = available_cpus()
+    n_workers = min(n_workers, n_estimators)
+    n_threads = threads_per_worker(n_workers)
+
+    shares = np.array_split(np.arange(n_estimators), n_workers)
+
+    shared, folder = share_matrices({"X": X, "y": y}, folder)
+
+    try:
+        shards = Parallel(n_jobs=n_workers, backend=backend)(
+            delayed(fit_shard)(
+                settings, shared["X"], shared["y"], int(share[0]), len(share), n_threads
+            )
+            for share in shares
+        )
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return merge_forests(shards)
+
+
+def scaling_report(
+    split_dict: dict, settings: dict, worker_counts: list = None
+) -> pd.DataFrame:
+    """
+    Input:
+        split_dict : split_dict containing x/y train/val/test
+        settings: forest settings, like BEST_MODEL["settings"]
+        worker_counts: numbers of workers to try, defaults to 1, 2, 4, ... up to the number of cpus
+
+    Fits the forest with each number of workers, and compares the time with the single worker fit.
+    Efficiency is speedup / workers, 1.0 means adding workers gives a perfect speedup.
+    Also checks that every merged forest predicts the same as the single worker one.
+
+    Returns a dataframe with one row per number of workers
+    """
+
+    if worker_counts is None:
+        worker_counts = [2**i for i in range(int(np.log2(available_cpus())) + 1)]
+
+    X_train = get_matrix(split_dict, "x_train", RandomForestRegressor)
+    y_train = get_matrix(split_dict, "y_train", RandomForestRegressor)
+    X_val = get_matrix(split_dict, "x_val", RandomForestRegressor)
+
+    rows = []
+    baseline = None
+
+    for n_workers in worker_counts:
+        start_time = time.perf_counter()
+        forest = sharded_forest_fit(settings, X_train, y_train, n_workers)
+        seconds = time.perf_counter() - start_time
+
+        y_predicted = forest.predict(X_val)
+        if baseline is None:
+            baseline = {"seconds": seconds, "y_predicted": y_predicted}
+
+        speedup = baseline["seconds"] / seconds
+        rows.append(
+            {
+                "workers": n_workers,
+                "fit_seconds": round(seconds, 2),
+                "speedup": round(speedup, 2),
+                "efficiency": round(speedup / n_workers, 2),
+                "max_abs_difference": float(
+                    np.abs(y_predicted - baseline["y_predicted"]).max()
+                ),
+            }
+        )
+        print(f"MODELS : Sharded fit on {n_workers} workers took {round(seconds, 2)}s")
+
+    report = pd.DataFrame(rows)
+    print(report)
+
+    return report
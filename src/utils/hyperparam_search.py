@@ -0,0 +1,211 @@
+import itertools
+import math
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from matplotlib import pyplot as plt
+from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+
+from utils.matrices import get_matrix, matrix_name
+from utils.models import fit_and_score
+from utils.parallel import available_cpus, share_matrices, threads_per_worker
+
+RANDOM_STATE = 2
+PWD = Path().absolute()
+
+# the values tried for each model, every combination is a possible configuration
+SEARCH_SPACE = {
+    RandomForestRegressor: {
+        "n_estimators": [50, 100, 181, 250],
+        "max_depth": [None, 12, 20, 30],
+        "min_samples_leaf": [1, 2, 5, 10],
+        "max_features": [1.0, 0.5, "sqrt"],
+    },
+    GradientBoostingRegressor: {
+        "n_estimators": [100, 200, 400],
+        "max_depth": [3, 5, 8],
+        "min_samples_leaf": [1, 5, 20],
+        "max_features": [None, 0.5, "sqrt"],
+    },
+}
+
+
+def sample_configurations(search_space: dict, n_candidates: int) -> list:
+    """
+    Input:
+        search_space: dict of model type -> dict of parameter -> values to try
+        n_candidates: number of configurations to draw
+
+    Returns a list of model dicts (like in train_models), drawn without replacement
+    from every combination in the search space
+    """
+
+    all_configs = []
+
+    for model_type, params in search_space.items():
+        for values in itertools.product(*params.values()):
+            settings = dict(zip(params.keys(), values))
+            settings["random_state"] = RANDOM_STATE
+            all_configs.append({"model_type": model_type, "settings": settings})
+
+    rng = np.random.RandomState(RANDOM_STATE)
+    n_candidates = min(n_candidates, len(all_configs))
+    chosen = rng.choice(len(all_configs), size=n_candidates, replace=False)
+
+    return [all_configs[i] for i in chosen]
+
+
+def score_on_subsample(
+    model_type: type,
+    settings: dict,
+    X_train,
+    y_train,
+    X_val,
+    y_val,
+    rows: np.ndarray,
+    n_threads: int,
+) -> (float, float):
+    """
+    Trains a model on the given rows of the training data and finds its MSE on validation data
+
+    Returns the MSE and the seconds spent training/predicting
+    """
+    start_time = time.time()
+    mse = fit_and_score(
+        model_type,
+        settings,
+        X_train[rows],
+        y_train[rows],
+        X_val,
+        y_val,
+        n_threads,
+    )
+    return mse, time.time() - start_time
+
+
+def successive_halving_search(
+    split_dict: dict,
+    search_space: dict = None,
+    n_candidates: int = 81,
+    eta: int = 3,
+    n_workers: int = None,
+) -> (dict, pd.DataFrame):
+    """
+    Input:
+        split_dict : split_dict containing x/y train/val/test
+        search_space: see SEARCH_SPACE, which is used if None
+        n_candidates: how many configurations to start with
+        eta: only the best 1/eta configurations are promoted to the next rung,
+             which gets eta times as much training data
+        n_workers: number of processes to use, defaults to one per cpu
+
+    Searches for the best model with successive halving. Every configuration is first trained on a
+    small random subsample of the training data, and only the best ones are trained again on more data.
+    The last rung uses all the training data, so its MSE values compare with the ones in train_models.
+
+    Returns:
+        best: model dict of the best configuration, with its "rmse"
+        results: dataframe of every configuration trained, at every rung
+    """
+
+    if search_space is None:
+        search_space = SEARCH_SPACE
+
+    X_train = split_dict["x_train"]
+    n_rows = len(X_train)
+
+    candidates = sample_configurations(search_space, n_candidates)
+
+    # the number of rungs needed to get down to a single configuration, counted with
+    # the same integer division as the promotions below (math.log(243, 3) is 4.999..)
+    n_rungs = 1
+    remaining = len(candidates)
+    while remaining > 1:
+        remaining = max(1, remaining // eta)
+        n_rungs += 1
+    min_fraction = 1 / eta ** (n_rungs - 1)
+
+    if n_workers is None:
+        n_workers = min(len(candidates), available_cpus())
+    n_threads = threads_per_worker(n_workers)
+
+    # one shuffle of the rows, each rung uses the first part of it -> rungs are nested
+    row_order = np.random.RandomState(RANDOM_STATE).permutation(n_rows)
+
+    # each configuration gets the matrices with the dtype its model uses
+    keys = ["x_train", "y_train", "x_val", "y_val"]
+    shared, folder = share_matrices(
+        {
+            matrix_name(key, mod["model_type"]): get_matrix(
+                split_dict, key, mod["model_type"]
+            )
+            for mod in candidates
+            for key in keys
+        }
+    )
+
+    rung_results = []
+
+    try:
+        for rung in range(n_rungs):
+            fraction = min(1.0, min_fraction * eta**rung)
+            rows = np.sort(row_order[: max(1, int(n_rows * fraction))])
+
+            print(
+                f"MODELS : Halving rung {rung}: {len(candidates)} configurations on {len(rows)} rows"
+            )
+
+            scores = Parallel(n_jobs=n_workers)(
+                delayed(score_on_subsample)(
+                    mod["model_type"],
+                    mod["settings"],
+                    *[shared[matrix_name(key, mod["model_type"])] for key in keys],
+                    rows,
+                    n_threads,
+                )
+                for mod in candidates
+            )
+
+            for mod, (mse, seconds) in zip(candidates, scores):
+                rung_results.append(
+                    {
+                        "rung": rung,
+                        "n_rows": len(rows),
+                        "model_name": f"{str(mod['model_type'].__name__)[0:8]}_{mod['settings']}",
+                        "mse_values": math.sqrt(mse),
+                        "seconds": seconds,
+                    }
+                )
+                mod["rmse"] = math.sqrt(mse)
+
+            # promote the best 1/eta of the configurations
+            candidates = sorted(candidates, key=lambda mod: mod["rmse"])
+            if rung < n_rungs - 1:
+                candidates = candidates[: max(1, len(candidates) // eta)]
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    results = pd.DataFrame(rung_results)
+    final_rung = results[results["rung"] == n_rungs - 1].sort_values(by="mse_values")
+
+    print(final_rung[["model_name", "mse_values"]])
+    print(
+        f"MODELS : Halving search trained {len(results)} models in {round(results['seconds'].sum(), 2)} cpu seconds"
+    )
+
+    plt.figure(figsize=(10, 8))
+    plt.barh(final_rung["model_name"], final_rung["mse_values"])
+    plt.title("MSE values for the last rung of the successive halving search")
+    plt.xlabel("Mean Error")
+    plt.ylabel("Model")
+    plt.tight_layout()
+    plt.savefig(f"{PWD}/figs/MSE_halving_search.png")
+
+    best = candidates[0]
+    print(f"MODELS : Best model from halving search: {final_rung['model_name'].iloc[0]}")
+
+    return best, results
@@ -0,0 +1,161 @@
+import shutil
+import time
+from math import sqrt
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from threadpoolctl import threadpool_limits
+
+from utils.matrices import get_matrix
+from utils.parallel import available_cpus, share_matrices, threads_per_worker
+
+RANDOM_STATE = 2
+
+
+def score_permutations(
+    model,
+    X_shared,
+    y: np.ndarray,
+    baseline_rmse: float,
+    tasks: list,
+    n_threads: int,
+    deadline: float = None,
+) -> list:
+    """
+    Input:
+        model: fitted model
+        X_shared: the (memory mapped) validation matrix
+        y: validation targets
+        baseline_rmse: RMSE of the model on the unpermuted data
+        tasks: list of (feature position, repeat) to score
+        n_threads: threads this worker may use
+        deadline: time.time() after which no new tasks are started
+
+    Copies X once for this worker, then shuffles one coloumn at a time in place and puts it back after
+    predicting, so no other copies are made.
+
+    Returns a list of dicts with the feature position, repeat and the RMSE increase
+    """
+
+    X = np.array(X_shared)
+    if "n_jobs" in model.get_params():
+        model.set_params(n_jobs=n_threads)
+
+    results = []
+
+    with threadpool_limits(limits=n_threads):
+        for feature, repeat in tasks:
+            if deadline is not None and time.time() > deadline:
+                break
+
+            # seeded by feature and repeat, so the result does not depend on the number of workers
+            rng = np.random.RandomState(RANDOM_STATE + feature * 1000 + repeat)
+            original = X[:, feature].copy()
+            X[:, feature] = original[rng.permutation(len(X))]
+
+            y_predicted = model.predict(X)
+            X[:, feature] = original
+
+            results.append(
+                {
+                    "feature": feature,
+                    "repeat": repeat,
+                    "rmse_increase": sqrt(np.mean((y_predicted - y) ** 2)) - baseline_rmse,
+                }
+            )
+
+    return results
+
+
+def permutation_importance_report(
+    model,
+    split_dict: dict,
+    n_repeats: int = 5,
+    n_workers: int = None,
+    time_budget: float = None,
+) -> pd.DataFrame:
+    """
+    Input:
+        model: fitted model
+        split_dict : split_dict containing x/y train/val/test, see utils.matrices
+        n_repeats: how many times each feature is shuffled
+        n_workers: number of processes to use, defaults to one per cpu
+        time_budget: seconds after which workers stop starting new permutations. Tasks are
+                     handed out one repeat at a time, so every feature gets its first repeats
+
+    How much worse the model gets on validation data when a feature is shuffled, which unlike
+    feature_importances_ is not biased towards coloumns with many unique values.
+    The baseline prediction is only made once, and all (feature, repeat) pairs are spread over the workers.
+
+    Returns a dataframe with the mean and std RMSE increase of every feature, most important first
+    """
+
+    X_val = get_matrix(split_dict, "x_val", type(model))
+    y_val = get_matrix(split_dict, "y_val", type(model))
+    feature_names = split_dict.get("feature_names", list(split_dict["x_train"].columns))
+
+    baseline_rmse = sqrt(np.mean((model.predict(X_val) - y_val) ** 2))
+
+    tasks = [
+        (feature, repeat)
+        for repeat in range(n_repeats)
+        for feature in range(X_val.shape[1])
+    ]
+
+    if n_workers is None:
+        n_workers = min(len(tasks), available_cpus())
+    n_threads = threads_per_worker(n_workers)
+    deadline = None if time_budget is None else time.time() + time_budget
+
+    print(
+        f"MODELS : Permutation importance of {X_val.shape[1]} features x {n_repeats} repeats on {n_workers} workers"
+    )
+
+    shared, folder = share_matrices({"x_val": X_val})
+
+    try:
+        results = Parallel(n_jobs=n_workers)(
+            delayed(score_permutations)(
+                model,
+                shared["x_val"],
+                y_val,
+                baseline_rmse,
+                tasks[worker::n_workers],
+                n_threads,
+                deadline,
+            )
+            for worker in range(n_workers)
+        )
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    scores = pd.DataFrame(
+        [result for worker in results for result in worker],
+        columns=["feature", "repeat", "rmse_increase"],
+    ).astype({"feature": int, "rmse_increase": float})
+    scores["Feature"] = [feature_names[i] for i in scores["feature"]]
+
+    # features the time budget ran out before are kept, with NaN and 0 repeats
+    report = (
+        scores.groupby("Feature")["rmse_increase"]
+        .agg(["mean", "std", "count"])
+        .reindex(feature_names)
+        .rename_axis("Feature")
+        .fillna({"count": 0})
+        .astype({"count": int})
+        .rename(
+            columns={
+                "mean": "rmse_increase_mean",
+                "std": "rmse_increase_std",
+                "count": "n_repeats",
+            }
+        )
+        .sort_values(by="rmse_increase_mean", ascending=False)
+        .reset_index()
+    )
+
+    print(f"MODELS : Baseline RMSE: {baseline_rmse}")
+    print(report)
+
+    return report
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+from sklearn.tree import DecisionTreeRegressor
+
+# sklearn trees work on float32, every other model converts to float64
+FLOAT32_MODELS = (RandomForestRegressor, DecisionTreeRegressor, GradientBoostingRegressor)
+
+SPLIT_PARTS = ["train", "val", "test"]
+
+
+def model_dtype(model_type: type) -> type:
+    """
+    Returns the dtype sklearn converts X to when fitting/predicting with model_type
+    """
+    if issubclass(model_type, FLOAT32_MODELS):
+        return np.float32
+    return np.float64
+
+
+def to_matrix(X, dtype: type) -> np.ndarray:
+    """
+    Returns X as a C-contiguous array of dtype, without copying if it already is one
+    """
+    if isinstance(X, (pd.DataFrame, pd.Series)):
+        X = X.to_numpy(dtype=dtype)
+    return np.ascontiguousarray(X, dtype=dtype)
+
+
+def add_matrices(split_dict: dict) -> dict:
+    """
+    Input:
+        split_dict : split_dict containing x/y train/val/test as dataframes
+
+    Adds the data as C-contiguous arrays, so models get data they do not have to convert:
+        x_train_f32, x_train_f64 (and the same for val/test)
+        y_train_f64 (and the same for val/test)
+        feature_names: the coloumn names of x, in the order of the matrix coloumns
+
+    Returns the same split_dict
+    """
+
+    split_dict["feature_names"] = list(split_dict["x_train"].columns)
+
+    for part in SPLIT_PARTS:
+        X = split_dict[f"x_{part}"][split_dict["feature_names"]]
+        split_dict[f"x_{part}_f32"] = to_matrix(X, np.float32)
+        split_dict[f"x_{part}_f64"] = to_matrix(X, np.float64)
+        split_dict[f"y_{part}_f64"] = to_matrix(split_dict[f"y_{part}"], np.float64)
+
+    return split_dict
+
+
+def matrix_name(key: str, model_type: type) -> str:
+    """
+    Returns the name the matrix for key ("x_train", "y_val" etc.) is cached under for model_type
+    """
+    if key.startswith("y_") or model_dtype(model_type) == np.float64:
+        return f"{key}_f64"
+    return f"{key}_f32"
+
+
+def get_matrix(split_dict: dict, key: str, model_type: type) -> np.ndarray:
+    """
+    Input:
+        split_dict : split_dict, ideally passed through add_matrices first
+        key: "x_train", "y_val" etc.
+        model_type: the model the data is for
+
+    Returns the cached matrix with the dtype model_type needs, converting it if it is not cached
+    """
+
+    name = matrix_name(key, model_type)
+
+    if name in split_dict:
+        return split_dict[name]
+
+    dtype = np.float32 if name.endswith("_f32") else np.float64
+    return to_matrix(split_dict[key], dtype)
+
+
+def fit_data(split_dict: dict, model_type: type) -> tuple:
+    """
+    Returns X_train, y_train, X_val, y_val as the matrices model_type needs
+    """
+    return tuple(
+        get_matrix(split_dict, key, model_type)
+        for key in ["x_train", "y_train", "x_val", "y_val"]
+    )
+
+
+def estimated_conversion_bytes(X, model_type: type) -> int:
+    """
+    Estimates how many bytes sklearn copies when converting X (not y) for model_type,
+    from its type, dtype and layout. 0 if X already is a C-contiguous array of the right dtype
+    """
+    dtype = model_dtype(model_type)
+
+    if (
+        isinstance(X, np.ndarray)
+        and X.dtype == dtype
+        and X.flags["C_CONTIGUOUS"]
+    ):
+        return 0
+
+    return int(np.prod(X.shape)) * np.dtype(dtype).itemsize
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+# models fitted in this process, keyed by model_key
+_REGISTRY = {}
+
+
+def data_hash(X, y) -> str:
+    """
+    Returns a hash of the training data.
+    For dataframes the index and coloumn names are included, for arrays the dtype and shape
+    """
+    hasher = hashlib.sha256()
+
+    for data in (X, y):
+        if isinstance(data, pd.DataFrame):
+            hasher.update(",".join(map(str, data.columns)).encode())
+
+        if isinstance(data, (pd.DataFrame, pd.Series)):
+            hasher.update(
+                pd.util.hash_pandas_object(data, index=True).to_numpy().tobytes()
+            )
+        else:
+            hasher.update(f"{data.dtype}{data.shape}".encode())
+            hasher.update(np.ascontiguousarray(data).tobytes())
+
+    return hasher.hexdigest()
+
+
+def model_key(model_type: type, settings: dict, X, y) -> str:
+    """
+    Returns a key that is the same for two models only if they have the same type,
+    settings and training data
+    """
+    settings_text = json.dumps(settings, sort_keys=True, default=str)
+    hasher = hashlib.sha256(f"{model_type.__name__}:{settings_text}".encode())
+    hasher.update(data_hash(X, y).encode())
+    return hasher.hexdigest()[:32]
+
+
+def get_or_fit(
+    model_type: type,
+    settings: dict,
+    X,
+    y,
+    cache_dir: str = None,
+):
+    """
+    Input:
+        model_type: the model class
+        settings: settings the model is made with
+        X/y: training data
+        cache_dir: folder to also look for/save the fitted model in, None to only keep it in memory
+
+    Returns a fitted model. A model is only fitted if the same model on the same data
+    has not been fitted before in this process (or saved in cache_dir)
+    """
+
+    key = model_key(model_type, settings, X, y)
+
+    if key in _REGISTRY:
+        print(f"MODELS : Reusing fitted {model_type.__name__} {key}")
+        return _REGISTRY[key]
+
+    cache_path = f"{cache_dir}/{key}.pkl" if cache_dir is not None else None
+
+    if cache_path is not None and os.path.exists(cache_path):
+        print(f"MODELS : Loading cached {model_type.__name__} from {cache_path}")
+        with open(cache_path, "rb") as f:
+            model = pickle.load(f)
+    else:
+        print(f"MODELS : Fitting {model_type.__name__}_{settings}")
+        model = model_type(**settings)
+        model.fit(X, y)
+
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+            # write to a temp file first so a crash never leaves half a model in the cache
+            with open(f"{cache_path}.tmp", "wb") as f:
+                pickle.dump(model, f)
+            os.replace(f"{cache_path}.tmp", cache_path)
+
+    _REGISTRY[key] = model
+    return model
+
+
+def clear_registry() -> None:
+    """
+    Forgets every model fitted in this process
+    """
+    _REGISTRY.clear()
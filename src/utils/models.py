@@ -1,35 +1,189 @@
+import shutil
 from math import sqrt
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
 from matplotlib import pyplot as plt
 from sklearn.dummy import DummyRegressor
-from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+from sklearn.ensemble import (
+    GradientBoostingRegressor,
+    HistGradientBoostingRegressor,
+    RandomForestRegressor,
+)
 from sklearn.linear_model import ElasticNet, Lasso
 from sklearn.metrics import mean_squared_error
 from sklearn.neighbors import KNeighborsRegressor
 from sklearn.svm import SVR
 from sklearn.tree import DecisionTreeRegressor
+from threadpoolctl import threadpool_limits
+
+from utils.cross_validation import cv_data, walk_forward_cv
+from utils.importance import permutation_importance_report
+from utils.matrices import (
+    estimated_conversion_bytes,
+    fit_data,
+    get_matrix,
+    matrix_name,
+)
+from utils.model_registry import get_or_fit
+from utils.parallel import available_cpus, share_matrices, threads_per_worker
 
 RANDOM_STATE = 2
 PWD = Path().absolute()
 
+# the model that performed best, see find_hyper_param_further
+BEST_MODEL = {
+    "model_type": RandomForestRegressor,
+    "settings": {"n_estimators": 181, "random_state": RANDOM_STATE},
+}
+
+# histogram boosting, much faster and smaller than the forest, and handles NaN without imputation
+HIST_GBM_MODEL = {
+    "model_type": HistGradientBoostingRegressor,
+    "settings": {
+        "max_iter": 500,
+        "learning_rate": 0.1,
+        "max_leaf_nodes": 63,
+        "random_state": RANDOM_STATE,
+    },
+}
+
 directory = f"{str(PWD)}/src/out"
 
+# (model type, shapes) whose conversion estimate has been printed, see fit_and_score
+_LOGGED_CONVERSIONS = set()
+
+
+def fit_and_score(
+    model_type: type,
+    settings: dict,
+    X_train,
+    y_train,
+    X_val,
+    y_val,
+    n_threads: int = None,
+) -> float:
+    """
+    Input:
+        model_type: the model class to train
+        settings: settings the model is made with
+        X_train/y_train: data to train on
+        X_val/y_val: data to find the MSE on
+        n_threads: max threads the model may use, None means no limit
+
+    Returns the MSE of the model on the validation data
+    """
+
+    # show if sklearn has to convert the data before it can use it (see utils.matrices),
+    # once per model type and data shape in each process
+    key = (model_type.__name__, X_train.shape, X_val.shape)
+    if key not in _LOGGED_CONVERSIONS:
+        _LOGGED_CONVERSIONS.add(key)
+        fit_bytes = estimated_conversion_bytes(X_train, model_type)
+        predict_bytes = estimated_conversion_bytes(X_val, model_type)
+        print(
+            f"MODELS : {model_type.__name__} fit copies ~{fit_bytes} bytes of X, "
+            f"predict ~{predict_bytes} bytes (estimate)"
+        )
+
+    clf = model_type(**settings)
+
+    if n_threads is None:
+        clf.fit(X_train, y_train)
+        y_predicted = clf.predict(X_val)
+    else:
+        # models with n_jobs use joblib threads, the rest may use BLAS/OpenMP threads
+        if "n_jobs" in clf.get_params():
+            clf.set_params(n_jobs=n_threads)
+
+        with threadpool_limits(limits=n_threads):
+            clf.fit(X_train, y_train)
+            y_predicted = clf.predict(X_val)
+
+    return mean_squared_error(y_val, y_predicted, squared=True)
+
+
+def estimated_cost(mod: dict) -> int:
+    """
+    Rough guess of how long a model in the model list takes to train, used to schedule the
+    slowest models first so they do not end up alone at the end of a parallel run
+    """
+    if mod["model_type"] in (RandomForestRegressor, GradientBoostingRegressor):
+        return mod["settings"].get("n_estimators", 100)
+    if mod["model_type"] is HistGradientBoostingRegressor:
+        # one histogram boosting iteration is a lot cheaper than an exact tree
+        return mod["settings"].get("max_iter", 100) // 10
+    if mod["model_type"] is SVR:
+        return 100
+    return 1
+
 
-def train_models(split_dict: dict) -> None:
+def score_models_parallel(models: list, split_dict: dict, n_workers: int = None) -> list:
     """
     Input:
+        models: list of model dicts (see train_models)
         split_dict : split_dict containing x/y train/val/test
-    Trains a variety of models on training data, and checks their MSE on validation data
+        n_workers: number of processes to use, defaults to one per cpu
+
+    Trains the models in a process pool and returns their MSE values in the same order as models.
+    The training matrices are memory mapped, so the workers share one copy of them.
     """
 
-    # grab train and validation data
-    X_train = split_dict["x_train"]
-    y_train = split_dict["y_train"]
-    X_val = split_dict["x_val"]
-    y_val = split_dict["y_val"]
+    if n_workers is None:
+        n_workers = min(len(models), available_cpus())
+
+    n_threads = threads_per_worker(n_workers)
+
+    print(
+        f"MODELS : Training {len(models)} models on {n_workers} workers with {n_threads} thread(s) each"
+    )
+
+    # each model gets the matrices with the dtype it uses
+    keys = ["x_train", "y_train", "x_val", "y_val"]
+    shared, folder = share_matrices(
+        {
+            matrix_name(key, mod["model_type"]): get_matrix(
+                split_dict, key, mod["model_type"]
+            )
+            for mod in models
+            for key in keys
+        }
+    )
+
+    # start the slowest models first, but keep track of where the result belongs
+    order = sorted(range(len(models)), key=lambda i: -estimated_cost(models[i]))
+
+    try:
+        results = Parallel(n_jobs=n_workers)(
+            delayed(fit_and_score)(
+                models[i]["model_type"],
+                models[i]["settings"],
+                *[shared[matrix_name(key, models[i]["model_type"])] for key in keys],
+                n_threads,
+            )
+            for i in order
+        )
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    mse_values_models = [None] * len(models)
+    for i, mse in zip(order, results):
+        mse_values_models[i] = mse
+
+    return mse_values_models
+
+
+def train_models(split_dict: dict, parallel: bool = False, cv_by: str = None) -> None:
+    """
+    Input:
+        split_dict : split_dict containing x/y train/val/test
+        parallel : if True the models are trained at the same time in a process pool
+        cv_by : "year" or "season" to score models with walk-forward cross validation
+                over training + validation data instead of the single validation split
+    Trains a variety of models on training data, and checks their MSE on validation data
+    """
 
     # models are saved as dicts in a list
     models = [
@@ -70,31 +224,36 @@ def train_models(split_dict: dict) -> None:
         {"model_type": DecisionTreeRegressor, "settings": {"max_depth": 12}},
         {"model_type": DecisionTreeRegressor, "settings": {"max_depth": 50}},
         {"model_type": DecisionTreeRegressor, "settings": {"max_depth": 100}},
+        HIST_GBM_MODEL,
     ]
 
     # intilaize
-    model_strings = []
-    mse_values_models = []
-    clf_vals = []
-
-    # loop over models, train and add values to list
-    for mod in models:
-        name = str(mod["model_type"].__name__)[0:8]
-        settings = mod["settings"]
-
-        print(f"MODELS : Training model type: {name}_{settings}")
-        clf = mod["model_type"](
-            **mod["settings"]  # henter ut settings her med unpacking
-        )
-        clf.fit(X_train, y_train)
-
-        y_predicted = clf.predict(X_val)
+    model_strings = [
+        f"{str(mod['model_type'].__name__)[0:8]}_{mod['settings']}" for mod in models
+    ]
 
-        pf_mse = mean_squared_error(y_val, y_predicted, squared=True)
+    if cv_by is not None:
+        X_cv, y_cv = cv_data(split_dict)
+        cv_results = walk_forward_cv(models, X_cv, y_cv, by=cv_by)
+        print(cv_results)
 
-        mse_values_models.append(pf_mse)
-        model_strings.append(f"{name}_{settings}")
-        clf_vals.append(clf)
+        # a models MSE is the mean over the folds
+        mean_rmse = cv_results.groupby("model_name", sort=False)["rmse"].mean()
+        mse_values_models = [mean_rmse[name] ** 2 for name in model_strings]
+    elif parallel:
+        mse_values_models = score_models_parallel(models, split_dict)
+    else:
+        mse_values_models = []
+
+        # loop over models, train and add values to list
+        for mod, model_string in zip(models, model_strings):
+            print(f"MODELS : Training model type: {model_string}")
+            pf_mse = fit_and_score(
+                mod["model_type"],
+                mod["settings"],  # henter ut settings her med unpacking
+                *fit_data(split_dict, mod["model_type"]),
+            )
+            mse_values_models.append(pf_mse)
 
     data_models = pd.DataFrame(
         {
@@ -117,17 +276,62 @@ def train_models(split_dict: dict) -> None:
     print("MODELS : Done training a variety of models!")
 
 
-def find_hyper_param(split_dict: dict) -> None:
+def warm_start_forest_mse(X_train, y_train, X_val, y_val, checkpoints: list) -> list:
+    """
+    Input:
+        X_train/y_train: data to train on
+        X_val/y_val: data to find the MSE on
+        checkpoints: the n_estimators values to find the MSE for
+
+    Grows one RandomForestRegressor with warm_start, only fitting the trees that are new since
+    the previous checkpoint. With the same random_state a forest of n trees is the first n trees
+    of a larger forest, so the MSEs are the same as fitting a new forest for each checkpoint.
+
+    The validation predictions of each tree are summed as the forest grows, so every tree
+    only predicts the validation data once.
+
+    Returns the MSE at each checkpoint, in the same order as checkpoints
+    """
+
+    clf = RandomForestRegressor(
+        n_estimators=1, random_state=RANDOM_STATE, warm_start=True
+    )
+
+    # trees are fitted on float32, predict on the same
+    X_val_array = np.asarray(X_val, dtype=np.float32)
+
+    prediction_sum = np.zeros(len(X_val_array))
+    mse_per_checkpoint = {}
+
+    for n_estimators in sorted(set(checkpoints)):
+        print(f"MODELS : Growing RandomForestRegressor to {n_estimators} trees")
+        n_before = len(clf.estimators_) if hasattr(clf, "estimators_") else 0
+
+        clf.set_params(n_estimators=n_estimators)
+        clf.fit(X_train, y_train)
+
+        # only the new trees need to predict
+        for tree in clf.estimators_[n_before:]:
+            prediction_sum += tree.predict(X_val_array, check_input=False)
+
+        y_predicted = prediction_sum / n_estimators
+
+        mse_per_checkpoint[n_estimators] = mean_squared_error(
+            y_val, y_predicted, squared=True
+        )
+
+    return [mse_per_checkpoint[n_estimators] for n_estimators in checkpoints]
+
+
+def find_hyper_param(split_dict: dict, warm_start: bool = True) -> None:
     """
     Input:
         split_dict : split_dict containing x/y train/val/test
+        warm_start : grow a single forest and score it at each n_estimators instead of refitting
     Trains RandomForestRegressor with multiple hyperparameters on training data, finds its MSE on validation data
     """
 
-    X_train = split_dict["x_train"]
-    y_train = split_dict["y_train"]
-    X_val = split_dict["x_val"]
-    y_val = split_dict["y_val"]
+    X_train, y_train, X_val, y_val = fit_data(split_dict, RandomForestRegressor)
 
     models = []
 
@@ -144,22 +348,36 @@ def find_hyper_param(split_dict: dict) -> None:
     mse_values_models = []
     clf_vals = []
 
-    for mod in models:
-        name = str(mod["model_type"].__name__)[0:8]
-        settings = mod["settings"]
+    if warm_start:
+        # every model only differs in n_estimators -> grow one forest instead
+        model_strings = [
+            f"{str(mod['model_type'].__name__)[0:8]}_{mod['settings']}"
+            for mod in models
+        ]
+        mse_values_models = warm_start_forest_mse(
+            X_train,
+            y_train,
+            X_val,
+            y_val,
+            [mod["settings"]["n_estimators"] for mod in models],
+        )
+    else:
+        for mod in models:
+            name = str(mod["model_type"].__name__)[0:8]
+            settings = mod["settings"]
 
-        print(f"MODELS : Training model type: {name}_{settings}")
-        clf = mod["model_type"](**mod["settings"])  # henter ut settings her
-        clf.fit(X_train, y_train)
+            print(f"MODELS : Training model type: {name}_{settings}")
+            clf = mod["model_type"](**mod["settings"])  # henter ut settings her
+            clf.fit(X_train, y_train)
 
-        y_predicted = clf.predict(X_val)
+            y_predicted = clf.predict(X_val)
 
-        # finn mse
-        pf_mse = mean_squared_error(y_val, y_predicted, squared=True)
+            # finn mse
+            pf_mse = mean_squared_error(y_val, y_predicted, squared=True)
 
-        mse_values_models.append(pf_mse)
-        model_strings.append(f"{name}_{settings}")
-        clf_vals.append(clf)
+            mse_values_models.append(pf_mse)
+            model_strings.append(f"{name}_{settings}")
+            clf_vals.append(clf)
 
     data_models = pd.DataFrame(
         {
@@ -195,17 +413,15 @@ def find_hyper_param(split_dict: dict) -> None:
     print("MODELS : Done training hyperparameter models!")
 
 
-def find_hyper_param_further(split_dict: dict) -> None:
+def find_hyper_param_further(split_dict: dict, warm_start: bool = True) -> None:
     """
     Input:
         split_dict : split_dict containing x/y train/val/test
+        warm_start : grow a single forest and score it at each n_estimators instead of refitting
     Trains a single model (testing multiple hyperparameters) on test data, finds its MSE on validation data
     """
 
-    X_train = split_dict["x_train"]
-    y_train = split_dict["y_train"]
-    X_val = split_dict["x_val"]
-    y_val = split_dict["y_val"]
+    X_train, y_train, X_val, y_val = fit_data(split_dict, RandomForestRegressor)
 
     models = []
 
@@ -222,22 +438,36 @@ def find_hyper_param_further(split_dict: dict) -> None:
     mse_values_models = []
     clf_vals = []
 
-    for mod in models:
-        name = str(mod["model_type"].__name__)[0:8]
-        settings = mod["settings"]
+    if warm_start:
+        # every model only differs in n_estimators -> grow one forest instead
+        model_strings = [
+            f"{str(mod['model_type'].__name__)[0:8]}_{mod['settings']}"
+            for mod in models
+        ]
+        mse_values_models = warm_start_forest_mse(
+            X_train,
+            y_train,
+            X_val,
+            y_val,
+            [mod["settings"]["n_estimators"] for mod in models],
+        )
+    else:
+        for mod in models:
+            name = str(mod["model_type"].__name__)[0:8]
+            settings = mod["settings"]
 
-        print(f"MODELS : Training model type: {name}_{settings}")
-        clf = mod["model_type"](**mod["settings"])  # henter ut settings her
-        clf.fit(X_train, y_train)
+            print(f"MODELS : Training model type: {name}_{settings}")
+            clf = mod["model_type"](**mod["settings"])  # henter ut settings her
+            clf.fit(X_train, y_train)
 
-        y_predicted = clf.predict(X_val)
+            y_predicted = clf.predict(X_val)
 
-        # finn mse
-        pf_mse = mean_squared_error(y_val, y_predicted, squared=True)
+            # finn mse
+            pf_mse = mean_squared_error(y_val, y_predicted, squared=True)
 
-        mse_values_models.append(pf_mse)
-        model_strings.append(f"{name}_{settings}")
-        clf_vals.append(clf)
+            mse_values_models.append(pf_mse)
+            model_strings.append(f"{name}_{settings}")
+            clf_vals.append(clf)
 
     data_models = pd.DataFrame(
         {
@@ -267,25 +497,100 @@ def find_hyper_param_further(split_dict: dict) -> None:
     return
 
 
-def train_best_model(split_dict: dict, test_data: bool) -> None:
+def get_best_model(
+    split_dict: dict, cache_dir: str = None, model: dict = None
+) -> RandomForestRegressor:
+    """
+    Returns the best model fitted on the training data.
+    model can be set to another model dict, like HIST_GBM_MODEL, defaults to BEST_MODEL
+
+    The model is only fitted the first time, after that the fitted model is reused from the
+    model registry (or loaded from cache_dir, if given and the model has been saved there).
+    """
+    if model is None:
+        model = BEST_MODEL
+
+    return get_or_fit(
+        model["model_type"],
+        model["settings"],
+        get_matrix(split_dict, "x_train", model["model_type"]),
+        get_matrix(split_dict, "y_train", model["model_type"]),
+        cache_dir,
+    )
+
+
+def forest_predict_intervals(
+    model: RandomForestRegressor, X, quantiles: tuple = (10, 90)
+) -> (np.ndarray, np.ndarray):
+    """
+    Input:
+        model: fitted forest
+        X: rows to predict on, a dataframe is put in the coloumn order the model was fitted with
+        quantiles: percentiles (0-100) to find across the trees
+
+    Every tree predicts the whole batch once, the mean of the trees is the normal forest prediction,
+    and the percentiles across the trees give a range around it. Nothing is refitted.
+
+    Returns the predictions, and an array of shape (rows, len(quantiles)) with the percentiles
+    """
+
+    if not isinstance(model, RandomForestRegressor):
+        raise ValueError(
+            f"Prediction intervals need a RandomForestRegressor, not {type(model).__name__}"
+        )
+
+    # the trees are called without input checks, so the coloumns are matched by name here
+    if isinstance(X, pd.DataFrame) and hasattr(model, "feature_names_in_"):
+        missing = set(model.feature_names_in_) - set(X.columns)
+        if missing:
+            raise ValueError(f"X is missing the features {sorted(missing)}")
+        X = X[model.feature_names_in_]
+
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    tree_predictions = np.stack(
+        [tree.predict(X, check_input=False) for tree in model.estimators_], axis=1
+    )
+
+    return tree_predictions.mean(axis=1), np.percentile(tree_predictions, quantiles, axis=1).T
+
+
+def train_best_model(
+    split_dict: dict,
+    test_data: bool,
+    cv_by: str = None,
+    cache_dir: str = None,
+    model: dict = None,
+    importance_report: bool = False,
+) -> RandomForestRegressor:
     """
     Trains the model that performed (RandomForestRegressor) best on validation/test data
+
+    If cv_by is "year" or "season" the model is also scored with walk-forward cross validation.
+    The fitted model is shared through the model registry, see get_best_model.
+    model can be set to another model dict, like HIST_GBM_MODEL, defaults to BEST_MODEL
+    If importance_report is True, permutation importance on validation data is printed as well
+    (see utils.importance), it is skipped for test data
+
+    Returns the fitted model
     """
 
-    if test_data:
-        X_chosen = split_dict["x_test"]
-        y_chosen = split_dict["y_test"]
-    else:
-        X_chosen = split_dict["x_val"]
-        y_chosen = split_dict["y_val"]
+    if model is None:
+        model = BEST_MODEL
 
-    X_train = split_dict["x_train"]
-    y_train = split_dict["y_train"]
+    if cv_by is not None and not test_data:
+        X_cv, y_cv = cv_data(split_dict)
+        cv_results = walk_forward_cv([model], X_cv, y_cv, by=cv_by)
+        print(cv_results)
+        print(f"MODELS : Mean walk-forward RMSE: {cv_results['rmse'].mean()}")
 
-    # BEST MODEL:
-    best_model = RandomForestRegressor(n_estimators=181, random_state=RANDOM_STATE)
+    part = "test" if test_data else "val"
+    X_chosen = get_matrix(split_dict, f"x_{part}", model["model_type"])
+    y_chosen = get_matrix(split_dict, f"y_{part}", model["model_type"])
 
-    best_model.fit(X_train, y_train)
+    feature_names = split_dict.get("feature_names", list(split_dict["x_train"].columns))
+
+    # BEST MODEL:
+    best_model = get_best_model(split_dict, cache_dir, model)
 
     y_test_predicted = best_model.predict(X_chosen)
 
@@ -296,8 +601,15 @@ def train_best_model(split_dict: dict, test_data: bool) -> None:
     print("MSE:", test_mse)
     print("RMSE:", test_rmse)
 
-    importance_df = pd.DataFrame(
-        {"Feature": X_train.columns, "Importance": best_model.feature_importances_}
-    )
+    # boosting with histograms has no impurity based importances
+    if hasattr(best_model, "feature_importances_"):
+        importance_df = pd.DataFrame(
+            {"Feature": feature_names, "Importance": best_model.feature_importances_}
+        )
+
+        print(importance_df.sort_values(by="Importance", ascending=False))
+
+    if importance_report and not test_data:
+        permutation_importance_report(best_model, split_dict, time_budget=600)
 
-    print(importance_df.sort_values(by="Importance", ascending=False))
+    return best_model
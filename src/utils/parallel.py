@@ -0,0 +1,59 @@
+import os
+import tempfile
+
+import joblib
+import numpy as np
+import pandas as pd
+
+
+def available_cpus() -> int:
+    """
+    Returns the number of cpus this process is allowed to run on
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity does not exist on windows/mac
+        return os.cpu_count() or 1
+
+
+def threads_per_worker(n_workers: int) -> int:
+    """
+    Input:
+        n_workers: number of processes that will run at the same time
+
+    Returns the number of threads each worker may use so the machine is not oversubscribed
+    """
+    return max(1, available_cpus() // max(1, n_workers))
+
+
+def share_matrices(arrays: dict, folder: str = None) -> (dict, str):
+    """
+    Dumps arrays to disk and opens them again as read-only memory maps.
+
+    joblib sends memory mapped arrays to workers by filename, so every worker
+    reads the same pages instead of receiving its own pickled copy.
+
+    Inputs:
+        arrays: dict of name -> np.ndarray/pd.DataFrame/pd.Series
+        folder: folder to place the memory mapped files in, a temp folder is made if None
+
+    Returns:
+        shared: dict of name -> np.memmap
+        folder: the folder the files were written to, remove it when done
+    """
+
+    if folder is None:
+        folder = tempfile.mkdtemp(prefix="cycle_memmap_")
+
+    shared = {}
+
+    for name, array in arrays.items():
+        if isinstance(array, (pd.DataFrame, pd.Series)):
+            array = array.to_numpy()
+
+        path = f"{folder}/{name}.mmap"
+        joblib.dump(np.ascontiguousarray(array), path)
+        shared[name] = joblib.load(path, mmap_mode="r")
+
+    return shared, folder